@@ -1,4 +1,5 @@
 import io
+import json
 import re
 import base64
 import pandas as pd
@@ -73,12 +74,25 @@ def split_image_text_types(docs):
     texts = []
     table_df = []
     for doc in docs:
+        # Records with a kind are routed on it, without looking at the content
+        kind = doc.metadata.get("kind") if isinstance(doc, Document) else None
+        if kind == "image":
+            # Stored as binary, the retriever returns the prompt sized rendition
+            b64_images.append(doc.page_content)
+            continue
+        if kind == "table":
+            table_df.append(pd.DataFrame(json.loads(doc.page_content)))
+            continue
+        if kind == "text":
+            texts.append(doc.page_content)
+            continue
         # Check if the document is of type Document and extract page_content if so
         if isinstance(doc, Document):
             doc = doc.page_content
         if isinstance(doc, pd.DataFrame):
             table_df.append(doc)
         elif looks_like_base64(doc) and is_image_data(doc):
+            # Images stored as base64 text before records had a kind
             doc = resize_base64_image(doc, size=(1300, 600))
             b64_images.append(doc)
         else:
@@ -99,7 +113,8 @@ def img_prompt_func(data_dict):
     if data_dict["context"]["tables"]:
         for table in data_dict["context"]["tables"]:
             df = pd.DataFrame(table)
-            table_message += str(df)
+            # to_string renders every row and column, str() elides large tables
+            table_message += df.to_string()
             table_message += "\n"  # add a newline between tables
 
     # Append table messages to formatted_texts
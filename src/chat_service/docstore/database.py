@@ -0,0 +1,27 @@
+import os
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def database_url(env_var, sqlite_file):
+    """
+    URL of a store's database: env_var when set, else the docstore's Postgres, else a local SQLite file
+    """
+    return os.getenv(env_var) or os.getenv("POSTGRES_CONNECTION_STRING") or f"sqlite:///{sqlite_file}"
+
+
+def upsert_statement(engine, table, index_columns, update_columns):
+    """
+    INSERT ... ON CONFLICT (index_columns) DO UPDATE SET update_columns, executed with a list of row dicts.
+    Postgres and SQLite both support it, through their own dialect constructs.
+    """
+    if engine.dialect.name == 'postgresql':
+        insert = postgresql.insert(table)
+    elif engine.dialect.name == 'sqlite':
+        insert = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f"Upserts are not supported on {engine.dialect.name}")
+    return insert.on_conflict_do_update(
+        index_elements=list(index_columns),
+        set_={column: insert.excluded[column] for column in update_columns}
+    )
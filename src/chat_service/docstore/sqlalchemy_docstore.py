@@ -1,44 +1,251 @@
 from langchain_core.stores import BaseStore
-from sqlalchemy import create_engine, Column, String, Text
+from sqlalchemy import bindparam, cast, create_engine, func, inspect, text, Column, LargeBinary, String, Text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 import json
+import os
+import threading
+import time
+import zlib
+
+from docstore.database import upsert_statement
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed to write or read zstd compressed rows
+    zstandard = None
+
+# Rows written per INSERT statement by mset
+DOCSTORE_BATCH_SIZE = int(os.getenv("DOCSTORE_BATCH_SIZE", "500"))
+# Codec text content is compressed with by mset: "none", "zstd" or "zlib"
+DOCSTORE_COMPRESSION = os.getenv("DOCSTORE_COMPRESSION", "none")
+# Text content shorter than this many bytes is stored uncompressed, it would barely shrink
+DOCSTORE_COMPRESSION_MIN_BYTES = int(os.getenv("DOCSTORE_COMPRESSION_MIN_BYTES", "256"))
+DOCSTORE_ZSTD_LEVEL = int(os.getenv("DOCSTORE_ZSTD_LEVEL", "3"))
 
 Base = declarative_base()
 
+
 class DocumentStore(Base):
     __tablename__ = 'documents'
 
     doc_id = Column(String, primary_key=True)
     content = Column(Text)
     meta_data = Column(Text)  # Store meta_data as JSON string
+    content_blob = Column(LargeBinary)  # Binary content such as images, content is NULL then
+    content_type = Column(String)  # Format of the content as a MIME type, e.g. text/plain or image/jpeg
+    kind = Column(String)  # "text", "table" or "image", NULL for rows written before kinds were recorded
+    content_compressed = Column(LargeBinary)  # Compressed UTF-8 text content, content is NULL then
+    compression = Column(String)  # Codec of content_compressed, NULL for uncompressed rows
+    rendition = Column(LargeBinary)  # Binary content prepared for prompts, e.g. a resized image
 
     def __init__(self, doc_id, content, meta_data):
         self.doc_id = doc_id
         self.content = content
         self.meta_data = json.dumps(meta_data)  # Serialize to JSON
 
+
+def compress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=DOCSTORE_ZSTD_LEVEL).compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Reading zstd compressed rows needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def byte_length(engine, column):
+    """
+    SQL expression for the size of a text column in bytes, length() counts characters
+    """
+    if engine.dialect.name == 'postgresql':
+        return func.octet_length(column)
+    if engine.dialect.name == 'sqlite':
+        return func.length(cast(column, LargeBinary))
+    return func.length(column)
+
+
+def add_missing_columns(engine, table):
+    """
+    create_all doesn't alter existing tables, add the columns introduced since the table was created.
+    Safe to run from several processes at once, a column another process added first is left alone.
+    """
+    existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=engine.dialect)
+        # SQLite has no ADD COLUMN IF NOT EXISTS, its duplicate column error is checked below
+        if_not_exists = 'IF NOT EXISTS ' if engine.dialect.name == 'postgresql' else ''
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {if_not_exists}{column.name} '
+                                        f'{column_type}'))
+        except DBAPIError:
+            if column.name not in {added['name'] for added in inspect(engine).get_columns(table.name)}:
+                raise
+
+
+_migrated_urls = set()
+_migrated_urls_lock = threading.Lock()
+
+
+def migrate(engine):
+    """
+    Create the documents table or add its missing columns, once per database and process
+    """
+    url = str(engine.url)
+    with _migrated_urls_lock:
+        if url in _migrated_urls:
+            return
+        Base.metadata.create_all(engine)
+        add_missing_columns(engine, DocumentStore.__table__)
+        _migrated_urls.add(url)
+
+
 class SQLAlchemyDocStore(BaseStore):
-    def __init__(self, db_url, namespace):
+    def __init__(self, db_url, namespace, batch_size=DOCSTORE_BATCH_SIZE, compression=DOCSTORE_COMPRESSION):
         self.engine = create_engine(db_url)
         self.Session = sessionmaker(bind=self.engine)
-        Base.metadata.create_all(self.engine)
+        migrate(self.engine)
         self.namespace = namespace
+        self.batch_size = batch_size
+        self.compression = None if compression == 'none' else compression
+
+    def _text_columns(self, content):
+        """
+        Returns the content, content_compressed and compression column values for text content
+        """
+        if self.compression and content is not None:
+            data = content.encode('utf-8')
+            if len(data) >= DOCSTORE_COMPRESSION_MIN_BYTES:
+                return None, compress(self.compression, data), self.compression
+        return content, None, None
 
     def mset(self, documents):
-        session = self.Session()
-        for doc_id, content, meta_data in documents:
-            doc = DocumentStore(doc_id=doc_id, content=content, meta_data=meta_data)
-            session.add(doc)
-        session.commit()
-        session.close()
+        """
+        Insert or overwrite documents with multi-row INSERT ... ON CONFLICT (doc_id) DO UPDATE statements,
+        so writing the same doc_ids again, e.g. on a retry, succeeds
+        documents: Iterable of (doc_id, content, meta_data) or (doc_id, content, meta_data, attributes).
+        content is a str, or bytes stored as binary.
+        attributes["kind"]: Optional kind of content, "text", "table" or "image"
+        attributes["content_type"]: Optional MIME type of the content
+        attributes["rendition"]: Optional bytes mget returns instead of binary content when asked for renditions
+        """
+        # The last value wins when a doc_id repeats, one statement can't update the same row twice
+        rows = {}
+        for doc_id, content, meta_data, *extra in documents:
+            attributes = extra[0] if extra else {}
+            binary = isinstance(content, bytes)
+            text_content, content_compressed, compression = self._text_columns(None if binary else content)
+            rows[doc_id] = {
+                'doc_id': doc_id,
+                'content': text_content,
+                'content_compressed': content_compressed,
+                'compression': compression,
+                'meta_data': json.dumps(meta_data),
+                'content_blob': content if binary else None,
+                'content_type': attributes.get('content_type'),
+                'kind': attributes.get('kind'),
+                'rendition': attributes.get('rendition'),
+            }
+        rows = list(rows.values())
+        if not rows:
+            return
+        statement = upsert_statement(self.engine, DocumentStore.__table__, ['doc_id'],
+                                     [column for column in rows[0] if column != 'doc_id'])
+        with self.engine.begin() as connection:
+            for start in range(0, len(rows), self.batch_size):
+                connection.execute(statement, rows[start:start + self.batch_size])
 
-    def mget(self, doc_ids):
+    def mget(self, doc_ids, rendition=False):
+        """
+        Returns {doc_id: (content, meta_data)}. Binary content is returned as bytes. The kind and MIME type
+        recorded for a row are returned as meta_data["kind"] and meta_data["content_type"], so callers can
+        route content without inspecting it.
+        rendition: Return the rendition of binary content that has one instead of the content itself,
+        the full binary content is not read then
+        """
         session = self.Session()
-        docs = session.query(DocumentStore).filter(DocumentStore.doc_id.in_(doc_ids)).all()
+        binary_column = DocumentStore.rendition if rendition else DocumentStore.content_blob
+        docs = session.query(DocumentStore.doc_id, DocumentStore.content, DocumentStore.meta_data,
+                             DocumentStore.kind, DocumentStore.content_type, binary_column,
+                             DocumentStore.content_blob.is_(None), DocumentStore.content_compressed,
+                             DocumentStore.compression) \
+            .filter(DocumentStore.doc_id.in_(doc_ids)).all()
+        if rendition:
+            # Binary content without a rendition
+            missing = [doc[0] for doc in docs if doc[5] is None and not doc[6]]
+            blobs = dict(session.query(DocumentStore.doc_id, DocumentStore.content_blob)
+                         .filter(DocumentStore.doc_id.in_(missing)).all()) if missing else {}
         session.close()
-        return {doc.doc_id: (doc.content, json.loads(doc.meta_data)) for doc in docs}  # Deserialize JSON
+        result = {}
+        for doc_id, content, meta_data, kind, content_type, data, no_blob, content_compressed, compression in docs:
+            meta_data = json.loads(meta_data)  # Deserialize JSON
+            if compression:
+                content = decompress(compression, content_compressed).decode('utf-8')
+            if not no_blob:
+                content = data if data is not None else blobs[doc_id]
+            if kind:
+                meta_data["kind"] = kind
+            if content_type:
+                meta_data["content_type"] = content_type
+            result[doc_id] = (content, meta_data)
+        return result
+
+    def compress_existing(self, codec, batch_size=None, pause=0.0, limit=None, on_batch=None):
+        """
+        Compress the text content of rows stored uncompressed, batch_size rows per transaction.
+        pause: Seconds to sleep between batches, so the tool can run next to live traffic
+        limit: Optional maximum number of rows to compress
+        on_batch: Optional callable invoked with the number of rows compressed so far after every batch
+        Returns the number of rows compressed.
+        """
+        batch_size = batch_size or self.batch_size
+        compressed = 0
+        # Rows too short to compress are skipped by their size, so every batch makes progress
+        while limit is None or compressed < limit:
+            size = batch_size if limit is None else min(batch_size, limit - compressed)
+            with self.engine.begin() as connection:
+                rows = connection.execute(
+                    DocumentStore.__table__.select()
+                    .with_only_columns(DocumentStore.doc_id, DocumentStore.content)
+                    .where(DocumentStore.compression.is_(None), DocumentStore.content.isnot(None),
+                           byte_length(self.engine, DocumentStore.content) >= DOCSTORE_COMPRESSION_MIN_BYTES)
+                    .limit(size)
+                    # Concurrent runs take different rows on Postgres, SQLite locks the whole database anyway
+                    .with_for_update(skip_locked=True)
+                ).all()
+                if not rows:
+                    break
+                # Rows rewritten by mset since they were read keep their new content
+                connection.execute(
+                    DocumentStore.__table__.update()
+                    .where(DocumentStore.doc_id == bindparam('b_doc_id'), DocumentStore.compression.is_(None),
+                           DocumentStore.content == bindparam('b_content')),
+                    [{'b_doc_id': doc_id, 'b_content': content, 'content': None, 'compression': codec,
+                      'content_compressed': compress(codec, content.encode('utf-8'))} for doc_id, content in rows]
+                )
+            compressed += len(rows)
+            if on_batch:
+                on_batch(compressed)
+            if pause:
+                time.sleep(pause)
+        return compressed
 
     def mdelete(self, doc_ids):
         session = self.Session()
@@ -1,3 +1,5 @@
+import base64
+
 from langchain.retrievers.multi_vector import MultiVectorRetriever
 from langchain_core.retrievers import Document
 
@@ -8,8 +10,10 @@ class CustomMultiVectorRetriever(MultiVectorRetriever):
         docs = self.vectorstore.similarity_search(query, **self.search_kwargs)
         doc_ids = [doc.metadata['doc_id'] for doc in docs]
 
-        # Fetch documents from docstore using the retrieved IDs
-        documents = self.docstore.mget(doc_ids)
+        # Fetch documents from docstore using the retrieved IDs, images come back as their prompt sized rendition
+        documents = self.docstore.mget(doc_ids, rendition=True)
 
-        return [Document(page_content=content, metadata=meta_data) for doc_id, (content, meta_data) in
-                documents.items()]
+        # Binary content is passed on base64 encoded, meta_data["content_type"] tells what it is
+        return [Document(page_content=base64.b64encode(content).decode("utf-8") if isinstance(content, bytes)
+                         else content, metadata=meta_data)
+                for doc_id, (content, meta_data) in documents.items()]
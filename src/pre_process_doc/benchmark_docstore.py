@@ -0,0 +1,115 @@
+"""
+Docstore compression benchmark.
+
+Stores the text of src/content/MOSL-Ex-Small.pdf, as chunks and as JSON table records, repeated until there are
+--rows rows, once per codec. It reports the bytes of content stored and the latency of mget batches as JSON.
+
+    python benchmark_docstore.py --rows 5000 --output docstore.json
+
+Runs against throwaway SQLite files unless --db-url points at a scratch Postgres database, whose documents table
+is emptied before every codec.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+from pypdf import PdfReader
+from sqlalchemy import func
+
+from docstore.sqlalchemy_docstore import DocumentStore, SQLAlchemyDocStore, byte_length, zstandard
+
+BENCHMARK_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'content', 'MOSL-Ex-Small.pdf')
+CHUNK_CHARS = 1500
+
+
+def sample_contents(pdf_path):
+    """
+    Text chunks of the PDF and JSON table records made of its lines
+    """
+    text = "\n".join(page.extract_text() or "" for page in PdfReader(pdf_path).pages)
+    chunks = [text[start:start + CHUNK_CHARS] for start in range(0, len(text), CHUNK_CHARS)]
+    lines = [line for line in text.splitlines() if line.strip()]
+    tables = [json.dumps([{"row": i, "value": line} for i, line in enumerate(lines[start:start + 20])])
+              for start in range(0, len(lines), 20)]
+    return [(chunk, "text") for chunk in chunks if chunk.strip()] + [(table, "table") for table in tables]
+
+
+def stored_bytes(docstore):
+    session = docstore.Session()
+    total = session.query(
+        func.coalesce(func.sum(byte_length(docstore.engine, DocumentStore.content)), 0),
+        func.coalesce(func.sum(func.length(DocumentStore.content_compressed)), 0),
+    ).one()
+    session.close()
+    return int(total[0]) + int(total[1])
+
+
+def run_codec(db_url, codec, contents, rows, batches, batch_size):
+    docstore = SQLAlchemyDocStore(db_url=db_url, namespace='benchmark', compression=codec)
+    session = docstore.Session()
+    session.query(DocumentStore).delete()
+    session.commit()
+    session.close()
+
+    doc_ids = [str(uuid.uuid4()) for _ in range(rows)]
+    documents = []
+    for i, doc_id in enumerate(doc_ids):
+        content, kind = contents[i % len(contents)]
+        documents.append((doc_id, content, {"file_id": "benchmark"},
+                          {"kind": kind, "content_type": "text/plain" if kind == "text" else "application/json"}))
+    write_start = time.perf_counter()
+    docstore.mset(documents)
+    write_seconds = time.perf_counter() - write_start
+
+    rng = random.Random(0)
+    latencies = []
+    for _ in range(batches):
+        batch = rng.sample(doc_ids, batch_size)
+        start = time.perf_counter()
+        docstore.mget(batch)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'codec': codec,
+        'rows': rows,
+        'stored_bytes': stored_bytes(docstore),
+        'mset_seconds': round(write_seconds, 3),
+        'mget_batch_size': batch_size,
+        'mget_median_ms': round(statistics.median(latencies) * 1000, 3),
+        'mget_p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark docstore compression')
+    parser.add_argument('--pdf', default=BENCHMARK_PDF)
+    parser.add_argument('--db-url', help='Scratch database, SQLite files in a temporary directory by default')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--batches', type=int, default=200, help='mget calls timed per codec')
+    parser.add_argument('--batch-size', type=int, default=10, help='Rows per mget, like one retrieval')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    contents = sample_contents(args.pdf)
+    codecs = ['none', 'zlib'] + (['zstd'] if zstandard is not None else [])
+    results = []
+    with tempfile.TemporaryDirectory(prefix='docstore-benchmark-') as tmp_dir:
+        for codec in codecs:
+            db_url = args.db_url or f"sqlite:///{os.path.join(tmp_dir, codec + '.sqlite')}"
+            results.append(run_codec(db_url, codec, contents, args.rows, args.batches, args.batch_size))
+
+    output = json.dumps({'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
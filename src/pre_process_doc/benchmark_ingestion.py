@@ -0,0 +1,237 @@
+"""
+Offline ingestion benchmark.
+
+Runs process_pdf end to end on src/content/MOSL-Ex-Small.pdf and on larger PDFs made by repeating its pages,
+with OpenAI chat and embeddings replaced by deterministic fakes with configurable latency and Pinecone by the
+in-memory index. Every run happens in its own process against empty SQLite caches, so runs don't share cached
+summaries or embeddings and peak memory is per run. Partitioning, Camelot and chunking run for real.
+
+    python benchmark_ingestion.py --scales 5 20 --repeats 3 --output results.json
+
+Compare the JSON of two commits to see which stages got faster or slower.
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'content', 'MOSL-Ex-Small.pdf')
+BENCHMARK_INDEX = 'benchmark'
+
+
+def make_synthetic_pdf(source_path, output_path, repeat):
+    """
+    Write a PDF made of the pages of source_path repeated `repeat` times
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(source_path)
+    writer = PdfWriter()
+    for _ in range(repeat):
+        for page in reader.pages:
+            writer.add_page(page)
+    with open(output_path, 'wb') as output:
+        writer.write(output)
+
+
+def install_fakes(chat_latency, embedding_latency):
+    """
+    Replace the OpenAI clients used by ingestion with deterministic local fakes
+    """
+    import numpy as np
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    import generate_summaries
+    import retriever
+
+    class FakeChatModel(BaseChatModel):
+        """Answers with a summary derived from the prompt after sleeping `latency` seconds"""
+        latency: float = 0.0
+
+        @property
+        def _llm_type(self):
+            return "fake-chat"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            content = messages[-1].content
+            if isinstance(content, list):
+                content = json.dumps(content, sort_keys=True)
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+            summary = f"Summary {digest}: {content[-300:]}"
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=summary))])
+
+    class FakeEmbeddings(Embeddings):
+        """Unit vectors seeded by the text, after sleeping `latency` seconds per request"""
+
+        def __init__(self, latency=0.0, size=1536):
+            self.latency = latency
+            self.size = size
+
+        def _embed(self, text):
+            seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+            vector = np.random.default_rng(seed).standard_normal(self.size)
+            return (vector / np.linalg.norm(vector)).tolist()
+
+        def embed_documents(self, texts):
+            time.sleep(self.latency)
+            return [self._embed(text) for text in texts]
+
+        def embed_query(self, text):
+            return self.embed_documents([text])[0]
+
+    generate_summaries.ChatOpenAI = lambda **kwargs: FakeChatModel(latency=chat_latency)
+    generate_summaries._image_model = None
+    retriever.OpenAIEmbeddings = lambda **kwargs: FakeEmbeddings(latency=embedding_latency)
+    retriever._embeddings = None
+
+
+def run_case(pdf_path, repeat, chat_latency, embedding_latency, result_path):
+    """
+    Ingest one PDF in this process and write its timings to result_path
+    """
+    install_fakes(chat_latency, embedding_latency)
+    from extraction import process_pdf
+    from retriever import get_index
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark-job-')
+    try:
+        file_name = 'benchmark.pdf'
+        if repeat > 1:
+            make_synthetic_pdf(pdf_path, os.path.join(work_dir, file_name), repeat)
+        else:
+            shutil.copy(pdf_path, os.path.join(work_dir, file_name))
+        metrics = {}
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        process_pdf(work_dir, file_name, BENCHMARK_INDEX, f'benchmark-x{repeat}', metrics=metrics)
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {
+        'wall_seconds': round(wall_seconds, 3),
+        'cpu_seconds': round(cpu_seconds, 3),
+        # Partitioning workers are child processes
+        'process_peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'children_peak_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        'vectors': get_index(BENCHMARK_INDEX).describe_index_stats()['total_vector_count'],
+        'stages': metrics.get('stages', {}),
+    }
+    with open(result_path, 'w') as result_file:
+        json.dump(result, result_file)
+
+
+def run_case_in_subprocess(args, repeat):
+    """
+    Run one case in a fresh interpreter with its own empty databases and return its result
+    """
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmp_dir:
+        database_url = f"sqlite:///{os.path.join(tmp_dir, 'benchmark.sqlite')}"
+        env = dict(os.environ)
+        env.update({
+            'POSTGRES_CONNECTION_STRING': database_url,
+            'SUMMARY_CACHE_URL': database_url,
+            'EMBEDDING_CACHE_URL': database_url,
+            'VECTOR_BACKEND': 'memory',
+            'OPENAI_API_KEY': 'benchmark',
+        })
+        # The fakes have no rate limits unless they are configured explicitly
+        env.setdefault('SUMMARY_REQUESTS_PER_MINUTE', str(10 ** 9))
+        env.setdefault('SUMMARY_TOKENS_PER_MINUTE', str(10 ** 9))
+        result_path = os.path.join(tmp_dir, 'result.json')
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-case', str(repeat), '--pdf', args.pdf,
+             '--chat-latency', str(args.chat_latency), '--embedding-latency', str(args.embedding_latency),
+             '--result', result_path],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        )
+        with open(result_path) as result_file:
+            return json.load(result_file)
+
+
+def summarize_runs(name, repeat, runs):
+    wall = statistics.median(run['wall_seconds'] for run in runs)
+    stages = {}
+    for stage in runs[0]['stages']:
+        stages[stage] = {
+            'wall_seconds': statistics.median(run['stages'][stage]['wall_seconds'] for run in runs),
+            'cpu_seconds': statistics.median(run['stages'][stage]['cpu_seconds'] for run in runs),
+            'peak_rss_bytes': max(run['stages'][stage].get('peak_rss_bytes', 0) for run in runs),
+            'items': runs[0]['stages'][stage].get('items', 0),
+        }
+    return {
+        'name': name,
+        'page_repeat': repeat,
+        'runs': len(runs),
+        'wall_seconds': wall,
+        'cpu_seconds': statistics.median(run['cpu_seconds'] for run in runs),
+        'documents_per_minute': round(60 / wall, 3) if wall else None,
+        'process_peak_rss_bytes': max(run['process_peak_rss_bytes'] for run in runs),
+        'children_peak_rss_bytes': max(run['children_peak_rss_bytes'] for run in runs),
+        'vectors': runs[0]['vectors'],
+        'stages': stages,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark process_pdf offline')
+    parser.add_argument('--pdf', default=BENCHMARK_PDF, help='PDF to ingest and to build synthetic PDFs from')
+    parser.add_argument('--scales', type=int, nargs='*', default=[5, 20],
+                        help='Synthetic PDFs repeating the pages this many times')
+    parser.add_argument('--repeats', type=int, default=1, help='Runs per case, medians are reported')
+    parser.add_argument('--chat-latency', type=float, default=0.5, help='Seconds per fake chat completion')
+    parser.add_argument('--embedding-latency', type=float, default=0.1, help='Seconds per fake embeddings request')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--run-case', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        run_case(args.pdf, args.run_case, args.chat_latency, args.embedding_latency, args.result)
+        return
+
+    cases = [(os.path.splitext(os.path.basename(args.pdf))[0], 1)] + \
+            [(f'synthetic-x{scale}', scale) for scale in args.scales]
+    report = {
+        'commit': git_commit(),
+        'settings': {
+            'chat_latency': args.chat_latency,
+            'embedding_latency': args.embedding_latency,
+            'repeats': args.repeats,
+        },
+        'cases': [],
+    }
+    for name, repeat in cases:
+        runs = [run_case_in_subprocess(args, repeat) for _ in range(args.repeats)]
+        report['cases'].append(summarize_runs(name, repeat, runs))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Partitioning parity check.
+
+Partitions src/content/MOSL-Ex-Small.pdf once with partition_pdf_single and once sharded across worker processes,
+then compares the chunks: their number, that page numbers never go backwards, and their text.
+
+    python check_partition_parity.py --workers 2 --pages-per-shard 1
+
+Exits with status 1 when the two paths disagree. Run it before raising PARTITION_WORKERS above 1.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from pdf_partitioning import partition_pdf_sharded, partition_pdf_single
+
+PARITY_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'content', 'MOSL-Ex-Small.pdf')
+
+
+def page_numbers(elements):
+    return [element.metadata.page_number for element in elements]
+
+
+def in_page_order(pages):
+    known = [page for page in pages if page is not None]
+    return all(earlier <= later for earlier, later in zip(known, known[1:]))
+
+
+def compare(single, sharded):
+    """
+    Returns a report of the differences between the chunks of the two paths, report['match'] tells if there are none
+    """
+    single_texts = [str(element) for element in single]
+    sharded_texts = [str(element) for element in sharded]
+    mismatches = [i for i, (a, b) in enumerate(zip(single_texts, sharded_texts)) if a != b]
+    report = {
+        'single_elements': len(single),
+        'sharded_elements': len(sharded),
+        'single_in_page_order': in_page_order(page_numbers(single)),
+        'sharded_in_page_order': in_page_order(page_numbers(sharded)),
+        'same_page_numbers': page_numbers(single) == page_numbers(sharded),
+        'same_text': single_texts == sharded_texts,
+        'first_text_mismatch': mismatches[0] if mismatches else None,
+    }
+    report['match'] = (report['single_elements'] == report['sharded_elements'] and report['sharded_in_page_order']
+                       and report['same_page_numbers'] and report['same_text'])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare sharded and single process partitioning')
+    parser.add_argument('--pdf', default=PARITY_PDF)
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes of the sharded path')
+    parser.add_argument('--pages-per-shard', type=int, default=1,
+                        help='Pages per shard, small values put more chunk boundaries at shard boundaries')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='partition-parity-')
+    try:
+        pdf_path = os.path.join(work_dir, os.path.basename(args.pdf))
+        shutil.copy(args.pdf, pdf_path)
+        single = partition_pdf_single(pdf_path, os.path.join(work_dir, 'single-figures'))
+        sharded = partition_pdf_sharded(pdf_path, os.path.join(work_dir, 'sharded-figures'), args.workers,
+                                        pages_per_shard=args.pages_per_shard)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = compare(single, sharded)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['match'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""
+Compress the text content of docstore rows written uncompressed, a batch per transaction.
+Rows are readable throughout, every row carries its own compression flag.
+
+    python compress_docstore.py --codec zstd --batch-size 500 --pause 0.5
+"""
+import argparse
+import os
+
+from logging_config import logger
+from docstore.sqlalchemy_docstore import DOCSTORE_BATCH_SIZE, SQLAlchemyDocStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compress existing docstore rows')
+    parser.add_argument('--db-url', default=os.getenv("POSTGRES_CONNECTION_STRING"))
+    parser.add_argument('--codec', default='zstd', choices=['zstd', 'zlib'])
+    parser.add_argument('--batch-size', type=int, default=DOCSTORE_BATCH_SIZE, help='Rows per transaction')
+    parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches')
+    parser.add_argument('--limit', type=int, help='Stop after this many rows')
+    args = parser.parse_args()
+
+    docstore = SQLAlchemyDocStore(db_url=args.db_url, namespace=None)
+    compressed = docstore.compress_existing(
+        args.codec, batch_size=args.batch_size, pause=args.pause, limit=args.limit,
+        on_batch=lambda count: logger.info(f"Compressed {count} docstore rows")
+    )
+    logger.info(f"Done, {compressed} rows compressed with {args.codec}")
+
+
+if __name__ == '__main__':
+    main()
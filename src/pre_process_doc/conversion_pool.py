@@ -0,0 +1,155 @@
+import atexit
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+
+from logging_config import logger
+
+# Long lived LibreOffice listeners Office files are converted on
+CONVERSION_LISTENERS = int(os.getenv("CONVERSION_LISTENERS", "2"))
+# Listeners use consecutive ports starting here
+CONVERSION_BASE_PORT = int(os.getenv("CONVERSION_BASE_PORT", "2002"))
+# Seconds a single conversion may take before its listener is restarted
+CONVERSION_TIMEOUT = int(os.getenv("CONVERSION_TIMEOUT", "180"))
+# Seconds a listener gets to start accepting connections
+LISTENER_START_TIMEOUT = int(os.getenv("LISTENER_START_TIMEOUT", "60"))
+
+# Set to false to convert DOCX and PPTX files to PDF before partitioning them
+OFFICE_NATIVE_EXTRACTION = os.getenv("OFFICE_NATIVE_EXTRACTION", "true").lower() in ['true', '1', 't', 'y', 'yes']
+# Office formats partitioned straight from their XML parts, by MIME type
+NATIVE_OFFICE_EXTENSIONS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': '.pptx',
+}
+
+LISTENER_HOST = "127.0.0.1"
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ConversionListener:
+    """
+    One `unoconv --listener` process, converting one file at a time
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+
+    def start(self):
+        logger.info(f"Starting conversion listener on port {self.port}")
+        # LibreOffice allows one instance per profile, so every listener gets its own
+        self.process = subprocess.Popen(
+            ['unoconv', '--listener', '--server', LISTENER_HOST, '--port', str(self.port),
+             f'--user-profile=/tmp/unoconv-profile-{self.port}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + LISTENER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.healthy():
+                return
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.5)
+        self.stop()
+        raise ConversionError(f"Conversion listener on port {self.port} did not start")
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def healthy(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection((LISTENER_HOST, self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def convert(self, input_path, output_path, timeout=CONVERSION_TIMEOUT):
+        if not self.healthy():
+            self.restart()
+        try:
+            result = subprocess.run(
+                ['unoconv', '--server', LISTENER_HOST, '--port', str(self.port), '--no-launch',
+                 '-f', 'pdf', '-o', output_path, input_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            # A hung LibreOffice keeps failing every later conversion, start a fresh one
+            self.restart()
+            raise ConversionError(f"Converting '{input_path}' timed out after {timeout}s")
+        if result.returncode != 0 or not os.path.exists(output_path):
+            if not self.healthy():
+                self.restart()
+            raise ConversionError(f"Converting '{input_path}' failed: {result.stderr.decode(errors='replace')}")
+
+
+class ConversionPool:
+    """
+    Hands every conversion to an idle listener, starting listeners on first use
+    """
+
+    def __init__(self, size=CONVERSION_LISTENERS, base_port=CONVERSION_BASE_PORT):
+        self.listeners = [ConversionListener(base_port + i) for i in range(size)]
+        self.idle = queue.Queue()
+        for listener in self.listeners:
+            self.idle.put(listener)
+
+    def convert(self, input_path, output_path, timeout=CONVERSION_TIMEOUT):
+        listener = self.idle.get()
+        try:
+            try:
+                listener.convert(input_path, output_path, timeout)
+            except ConversionError as e:
+                # One more attempt, the listener has been restarted if it crashed or hung
+                logger.info(f"Retrying conversion on port {listener.port}: {e}")
+                listener.convert(input_path, output_path, timeout)
+        finally:
+            self.idle.put(listener)
+
+    def stop(self):
+        for listener in self.listeners:
+            listener.stop()
+
+
+_conversion_pool = None
+_conversion_pool_lock = threading.Lock()
+
+
+def get_conversion_pool():
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is None:
+            _conversion_pool = ConversionPool()
+            atexit.register(_conversion_pool.stop)
+        return _conversion_pool
+
+
+def convert_to_pdf(file_path):
+    """
+    Convert an Office file to a PDF next to it and remove the Office file
+    Returns the path of the PDF
+    """
+    pdf_output_path = os.path.splitext(file_path)[0] + '.pdf'
+    get_conversion_pool().convert(file_path, pdf_output_path)
+    os.remove(file_path)
+    return pdf_output_path
@@ -0,0 +1,90 @@
+import os
+import pickle
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, or_, Column, DateTime, LargeBinary, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from docstore.database import database_url
+from logging_config import logger
+
+Base = declarative_base()
+
+CHECKPOINT_URL = database_url("CHECKPOINT_URL", "ingestion_checkpoints.sqlite")
+# Checkpoints of jobs that were never retried are deleted after this many hours
+CHECKPOINT_MAX_AGE_HOURS = int(os.getenv("CHECKPOINT_MAX_AGE_HOURS", "168"))
+
+
+class CheckpointRecord(Base):
+    __tablename__ = 'ingestion_checkpoints'
+
+    job_id = Column(String, primary_key=True)
+    stage = Column(String, primary_key=True)
+    payload = Column(LargeBinary)  # Pickled stage output
+    created = Column(DateTime, index=True)
+
+
+class CheckpointStore:
+    """
+    Output of every completed ingestion stage, keyed by job id and stage name,
+    so a retried or restarted job resumes after the last completed stage
+    """
+
+    def __init__(self, db_url):
+        self.engine = create_engine(db_url)
+        self.Session = sessionmaker(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+    def load(self, job_id):
+        """
+        Returns {stage: output} for the stages the job completed
+        """
+        session = self.Session()
+        records = session.query(CheckpointRecord).filter(CheckpointRecord.job_id == job_id).all()
+        session.close()
+        return {record.stage: pickle.loads(record.payload) for record in records}
+
+    def save(self, job_id, stage, output):
+        session = self.Session()
+        session.merge(CheckpointRecord(job_id=job_id, stage=stage, payload=pickle.dumps(output),
+                                       created=datetime.now()))
+        session.commit()
+        session.close()
+
+    def clear(self, job_id):
+        """
+        Delete the job's checkpoints and those of its sub-jobs, saved under "<job_id>/..."
+        """
+        session = self.Session()
+        session.query(CheckpointRecord).filter(
+            or_(CheckpointRecord.job_id == job_id, CheckpointRecord.job_id.startswith(f"{job_id}/", autoescape=True))
+        ).delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+    def purge(self, max_age_hours=CHECKPOINT_MAX_AGE_HOURS):
+        """
+        Delete checkpoints older than max_age_hours
+        """
+        session = self.Session()
+        deleted = session.query(CheckpointRecord) \
+            .filter(CheckpointRecord.created < datetime.now() - timedelta(hours=max_age_hours)) \
+            .delete(synchronize_session=False)
+        session.commit()
+        session.close()
+        if deleted:
+            logger.info(f"Purged {deleted} expired ingestion checkpoints")
+
+
+_checkpoint_store = None
+_checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store():
+    global _checkpoint_store
+    with _checkpoint_store_lock:
+        if _checkpoint_store is None:
+            _checkpoint_store = CheckpointStore(CHECKPOINT_URL)
+        return _checkpoint_store
@@ -0,0 +1,95 @@
+from sqlalchemy import and_, create_engine, or_, Column, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+import json
+
+from docstore.database import upsert_statement
+
+Base = declarative_base()
+
+# Order the content kinds are stored and returned in
+CONTENT_KINDS = ("text", "table", "image")
+
+
+class ContentRecord(Base):
+    __tablename__ = 'content_registry'
+
+    content_hash = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    content = Column(Text)
+    summary = Column(Text)
+    embedding = Column(Text)  # Store the summary vector as JSON string
+
+    def __init__(self, content_hash, kind, position, content, summary, embedding):
+        self.content_hash = content_hash
+        self.kind = kind
+        self.position = position
+        self.content = content
+        self.summary = summary
+        self.embedding = json.dumps(embedding)  # Serialize to JSON
+
+
+class ContentRegistry:
+    """
+    Results of the first ingestion of a file's bytes, keyed by a digest of those bytes:
+    for every text chunk, table and image the stored content, its summary and the summary's embedding.
+    """
+
+    def __init__(self, db_url):
+        self.engine = create_engine(db_url)
+        self.Session = sessionmaker(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+    def get(self, content_hash):
+        """
+        Returns {kind: {"contents": [...], "summaries": [...], "embeddings": [...]}} or None when the
+        bytes were never ingested
+        """
+        session = self.Session()
+        records = session.query(ContentRecord).filter(ContentRecord.content_hash == content_hash) \
+            .order_by(ContentRecord.kind, ContentRecord.position).all()
+        session.close()
+        if not records:
+            return None
+        entry = {kind: {"contents": [], "summaries": [], "embeddings": []} for kind in CONTENT_KINDS}
+        for record in records:
+            entry[record.kind]["contents"].append(record.content)
+            entry[record.kind]["summaries"].append(record.summary)
+            entry[record.kind]["embeddings"].append(json.loads(record.embedding))
+        return entry
+
+    def put(self, content_hash, entry):
+        """
+        Store an entry shaped like the one get returns, replacing any previous one in a single transaction.
+        Rows are upserted, so two jobs storing the same bytes at once don't fail on the primary key.
+        """
+        rows = []
+        counts = {}
+        for kind in CONTENT_KINDS:
+            items = entry.get(kind) or {"contents": [], "summaries": [], "embeddings": []}
+            counts[kind] = 0
+            for position, (content, summary, embedding) in enumerate(
+                    zip(items["contents"], items["summaries"], items["embeddings"])):
+                rows.append({'content_hash': content_hash, 'kind': kind, 'position': position,
+                             'content': content, 'summary': summary, 'embedding': json.dumps(embedding)})
+                counts[kind] = position + 1
+        session = self.Session()
+        try:
+            # Positions beyond the new entry's are left over from a previous, longer one
+            session.query(ContentRecord).filter(
+                ContentRecord.content_hash == content_hash,
+                or_(*[and_(ContentRecord.kind == kind, ContentRecord.position >= count)
+                      for kind, count in counts.items()])
+            ).delete(synchronize_session=False)
+            if rows:
+                session.execute(upsert_statement(self.engine, ContentRecord.__table__,
+                                                 ['content_hash', 'kind', 'position'],
+                                                 ['content', 'summary', 'embedding']), rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
@@ -0,0 +1,124 @@
+import os
+import threading
+from datetime import datetime
+
+from langchain_core.stores import BaseStore
+from sqlalchemy import create_engine, Column, DateTime, LargeBinary, String, func
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from docstore.database import database_url, upsert_statement
+from logging_config import logger
+
+Base = declarative_base()
+
+EMBEDDING_CACHE_URL = database_url("EMBEDDING_CACHE_URL", "embedding_cache.sqlite")
+# Embeddings kept before the least recently used ones are evicted
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+# Embeddings written between two eviction passes, a pass counts the whole cache
+EMBEDDING_CACHE_EVICT_EVERY = int(os.getenv("EMBEDDING_CACHE_EVICT_EVERY", "2000"))
+
+
+class EmbeddingRecord(Base):
+    __tablename__ = 'embedding_cache'
+
+    key = Column(String, primary_key=True)
+    value = Column(LargeBinary)
+    last_used = Column(DateTime, index=True)
+
+
+class SQLAlchemyByteStore(BaseStore):
+    """
+    Byte store backing CacheBackedEmbeddings, keys are the model namespace plus a hash of the embedded text.
+    CacheBackedEmbeddings doesn't catch store errors, so a cache that can't be read or written is logged and
+    treated as a miss rather than failing the embedding.
+    """
+
+    def __init__(self, db_url=EMBEDDING_CACHE_URL, max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+                 evict_every=EMBEDDING_CACHE_EVICT_EVERY):
+        self.engine = create_engine(db_url)
+        self.Session = sessionmaker(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+
+    def mget(self, keys):
+        if not keys:
+            return []
+        session = self.Session()
+        try:
+            records = session.query(EmbeddingRecord).filter(EmbeddingRecord.key.in_(keys)).all()
+            found = {record.key: record.value for record in records}
+            if found:
+                session.query(EmbeddingRecord).filter(EmbeddingRecord.key.in_(list(found))) \
+                    .update({EmbeddingRecord.last_used: datetime.now()}, synchronize_session=False)
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error reading the embedding cache: {e}")
+            found = {}
+        finally:
+            session.close()
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs):
+        """
+        Insert or overwrite embeddings with INSERT ... ON CONFLICT (key) DO UPDATE, so concurrent jobs
+        embedding the same text don't fail on the primary key. Evicts after every evict_every writes.
+        """
+        now = datetime.now()
+        # The last value wins when a key repeats, one statement can't update the same row twice
+        rows = {key: {'key': key, 'value': value, 'last_used': now} for key, value in key_value_pairs}
+        if not rows:
+            return
+        try:
+            statement = upsert_statement(self.engine, EmbeddingRecord.__table__, ['key'], ['value', 'last_used'])
+            with self.engine.begin() as connection:
+                connection.execute(statement, list(rows.values()))
+            with self._lock:
+                self._writes_since_evict += len(rows)
+                due = self._writes_since_evict >= self.evict_every
+                if due:
+                    self._writes_since_evict = 0
+            if due:
+                self.evict()
+        except Exception as e:
+            logger.error(f"Error writing {len(rows)} embeddings to the embedding cache: {e}")
+
+    def mdelete(self, keys):
+        session = self.Session()
+        session.query(EmbeddingRecord).filter(EmbeddingRecord.key.in_(keys)).delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+    def yield_keys(self, prefix=None):
+        session = self.Session()
+        query = session.query(EmbeddingRecord.key)
+        if prefix:
+            query = query.filter(EmbeddingRecord.key.like(f'{prefix}%'))
+        keys = query.all()
+        session.close()
+        for key, in keys:
+            yield key
+
+    def evict(self):
+        """
+        Delete least recently used embeddings until at most max_entries are left
+        """
+        session = self.Session()
+        try:
+            excess = session.query(func.count(EmbeddingRecord.key)).scalar() - self.max_entries
+            if excess > 0:
+                oldest = session.query(EmbeddingRecord.key).order_by(EmbeddingRecord.last_used).limit(excess)
+                evicted = [key for key, in oldest.all()]
+                session.query(EmbeddingRecord).filter(EmbeddingRecord.key.in_(evicted)) \
+                    .delete(synchronize_session=False)
+                session.commit()
+                logger.info(f"Evicted {len(evicted)} embeddings from the embedding cache")
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine, Column, DateTime, Integer, String, Text, func
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from docstore.database import database_url, upsert_statement
+from logging_config import logger
+
+Base = declarative_base()
+
+SUMMARY_CACHE_URL = database_url("SUMMARY_CACHE_URL", "summary_cache.sqlite")
+# Total summary bytes kept before the least recently used entries are evicted
+SUMMARY_CACHE_MAX_BYTES = int(os.getenv("SUMMARY_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Summaries written between two eviction passes, a pass sums the size of the whole cache
+SUMMARY_CACHE_EVICT_EVERY = int(os.getenv("SUMMARY_CACHE_EVICT_EVERY", "500"))
+
+
+def sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SummaryRecord(Base):
+    __tablename__ = 'summary_cache'
+
+    cache_key = Column(String, primary_key=True)
+    model = Column(String)
+    prompt_hash = Column(String)
+    content_hash = Column(String)
+    summary = Column(Text)
+    size = Column(Integer)
+    last_used = Column(DateTime, index=True)
+
+
+class SummaryCache:
+    """
+    LLM summaries keyed by (model name, prompt hash, content hash)
+    """
+
+    def __init__(self, db_url, max_bytes=SUMMARY_CACHE_MAX_BYTES, evict_every=SUMMARY_CACHE_EVICT_EVERY):
+        self.engine = create_engine(db_url)
+        self.Session = sessionmaker(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model, prompt, content):
+        return sha256("\0".join([model, sha256(prompt), sha256(content)]))
+
+    def mget(self, keys):
+        """
+        Returns {key: summary} for the keys found in the cache
+        """
+        if not keys:
+            return {}
+        session = self.Session()
+        records = session.query(SummaryRecord).filter(SummaryRecord.cache_key.in_(set(keys))).all()
+        found = {record.cache_key: record.summary for record in records}
+        if found:
+            session.query(SummaryRecord).filter(SummaryRecord.cache_key.in_(list(found))) \
+                .update({SummaryRecord.last_used: datetime.now()}, synchronize_session=False)
+            session.commit()
+        session.close()
+        with self._lock:
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def mset(self, entries):
+        """
+        Insert or overwrite summaries with INSERT ... ON CONFLICT (cache_key) DO UPDATE, so concurrent jobs
+        summarizing the same content don't fail on the primary key. Evicts after every evict_every writes.
+        entries: List of (key, model, prompt, content, summary)
+        """
+        if not entries:
+            return
+        now = datetime.now()
+        # The last summary wins when a key repeats, one statement can't update the same row twice
+        rows = {}
+        for key, model, prompt, content, summary in entries:
+            rows[key] = {'cache_key': key, 'model': model, 'prompt_hash': sha256(prompt),
+                         'content_hash': sha256(content), 'summary': summary,
+                         'size': len(summary.encode("utf-8")), 'last_used': now}
+        statement = upsert_statement(self.engine, SummaryRecord.__table__, ['cache_key'],
+                                     ['summary', 'size', 'last_used'])
+        with self.engine.begin() as connection:
+            connection.execute(statement, list(rows.values()))
+        with self._lock:
+            self._writes_since_evict += len(rows)
+            due = self._writes_since_evict >= self.evict_every
+            if due:
+                self._writes_since_evict = 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used summaries until the cache is back under max_bytes
+        """
+        session = self.Session()
+        try:
+            total = session.query(func.coalesce(func.sum(SummaryRecord.size), 0)).scalar()
+            if total > self.max_bytes:
+                evicted = []
+                for key, size in session.query(SummaryRecord.cache_key, SummaryRecord.size) \
+                        .order_by(SummaryRecord.last_used).all():
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(key)
+                    total -= size
+                session.query(SummaryRecord).filter(SummaryRecord.cache_key.in_(evicted)) \
+                    .delete(synchronize_session=False)
+                session.commit()
+                with self._lock:
+                    self.evictions += len(evicted)
+                logger.info(f"Evicted {len(evicted)} summaries from the summary cache")
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+_summary_cache = None
+_summary_cache_lock = threading.Lock()
+
+
+def get_summary_cache():
+    global _summary_cache
+    with _summary_cache_lock:
+        if _summary_cache is None:
+            _summary_cache = SummaryCache(SUMMARY_CACHE_URL)
+        return _summary_cache
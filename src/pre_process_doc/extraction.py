@@ -1,36 +1,102 @@
 # Python Libraries
+import io
 import os
+import shutil
+import zipfile
 import camelot
+import pandas as pd
 
 from langchain.text_splitter import CharacterTextSplitter
 from langchain_experimental.text_splitter import SemanticChunker
-from langchain_openai.embeddings import OpenAIEmbeddings
-from unstructured.partition.pdf import partition_pdf
 from logging_config import logger
 from PIL import Image
+from pypdf import PdfReader
+from unstructured.chunking.title import chunk_by_title
+from unstructured.partition.docx import partition_docx
+from unstructured.partition.pptx import partition_pptx
 
 # Import local python files
-from generate_summaries import generate_text_and_table_summaries, generate_img_summaries
-from retriever import create_multi_vector_retriever
+from ingestion_jobs import JobStage
+from stage_metrics import measure_stage
+from conversion_pool import convert_to_pdf, NATIVE_OFFICE_EXTENSIONS
+from pdf_partitioning import PARTITION_WORKERS, PARTITION_STRATEGY_PER_PAGE, FAST, CHUNKING_OPTIONS, \
+    partition_pdf_single, partition_pdf_sharded, detect_page_strategies, page_strategy_metrics, write_shards
+from generate_summaries import generate_text_and_table_summaries, generate_img_summaries, encode_image
+from retriever import create_multi_vector_retriever, embed_summaries, get_embeddings, content_digest, \
+    get_indexed_content, delete_indexed_content
+from docstore.checkpoint_store import get_checkpoint_store
+from docstore.content_registry import ContentRegistry
+
+# "elements" builds tables from the Table elements unstructured found and runs Camelot only on the other pages,
+# "camelot" re-parses the whole file with Camelot
+TABLE_EXTRACTION_MODE = os.getenv("TABLE_EXTRACTION_MODE", "elements")
+# Set to false to skip the Camelot pass over pages where unstructured found no table. With
+# PARTITION_STRATEGY_PER_PAGE on, that pass is the only source of tables on pages partitioned with fast
+TABLE_CAMELOT_FALLBACK = os.getenv("TABLE_CAMELOT_FALLBACK", "true").lower() in ['true', '1', 't', 'y', 'yes']
+# PDFs with more pages are processed in windows of this many pages, each written to the stores before the next
+# is partitioned, so memory depends on the window size instead of the document size. 0 processes PDFs whole.
+# Windows are chunked independently: a section or table running across a window boundary becomes two chunks,
+# small sections are not combined across it, and near-duplicate images are grouped within a window only (exact
+# repeats still hit the summary cache). Chunk digests depend on the boundaries, so changing the window size
+# makes the next incremental run re-index the file.
+PROCESS_WINDOW_PAGES = int(os.getenv("PROCESS_WINDOW_PAGES", "0"))
+
 
 # TODO: Amit to replace with Adobe
 # Extract elements from PDF
-def extract_pdf_elements(file_path, file_name):
+def extract_pdf_elements(file_path, file_name, img_path, workers=PARTITION_WORKERS, metrics=None):
     """
     Extract images, tables, and chunk text from a PDF file.
-    path: File path, which is used to dump images (.jpg)
-    fname: File name
-    """
-    return partition_pdf(
-        filename=file_path + file_name,
-        extract_images_in_pdf=True,
-        infer_table_structure=True,
-        chunking_strategy="by_title",
-        max_characters=4000,
-        new_after_n_chars=3800,
-        combine_text_under_n_chars=2000,
-        image_output_dir_path=file_path,
-    )
+    file_path: Directory holding the PDF
+    file_name: File name
+    img_path: Directory the extracted images (.jpg) are written to
+    workers: Processes partitioning page ranges in parallel, 1 partitions the whole file in this process
+    metrics: Optional dict the per page strategies are recorded in
+    """
+    pdf_path = os.path.join(file_path, file_name)
+    strategies = detect_page_strategies(pdf_path) if PARTITION_STRATEGY_PER_PAGE else None
+    if strategies is not None and metrics is not None:
+        metrics.update(page_strategy_metrics(strategies))
+    if workers > 1:
+        return partition_pdf_sharded(pdf_path, img_path, workers, strategies)
+    if strategies is not None and FAST in strategies:
+        # One shard per run of pages sharing a strategy
+        return partition_pdf_sharded(pdf_path, img_path, 1, strategies, pages_per_shard=len(strategies))
+    return partition_pdf_single(pdf_path, img_path)
+
+
+def save_office_images(office_path, img_path):
+    """
+    Save the images embedded in a DOCX/PPTX (its word/media or ppt/media parts) as .jpg files in img_path
+    """
+    os.makedirs(img_path, exist_ok=True)
+    number = 1
+    with zipfile.ZipFile(office_path) as archive:
+        media = sorted((name for name in archive.namelist() if '/media/' in name),
+                       key=lambda name: (len(name), name))
+        for name in media:
+            try:
+                with Image.open(io.BytesIO(archive.read(name))) as img:
+                    img.convert("RGB").save(os.path.join(img_path, f"figure-0-{number:04d}.jpg"))
+                number += 1
+            except Exception as e:
+                # Vector formats such as EMF/WMF can't be opened by PIL
+                logger.info(f"Skipping embedded image '{name}': {e}")
+
+
+# Extract elements straight from a DOCX/PPTX without converting it to PDF
+def extract_office_elements(file_path, file_name, img_path):
+    """
+    Extract images, tables, and chunk text from a DOCX or PPTX file.
+    Produces the same element types extract_pdf_elements does.
+    """
+    office_path = os.path.join(file_path, file_name)
+    if file_name.lower().endswith('.docx'):
+        elements = partition_docx(filename=office_path, infer_table_structure=True)
+    else:
+        elements = partition_pptx(filename=office_path, infer_table_structure=True)
+    save_office_images(office_path, img_path)
+    return chunk_by_title(elements, **CHUNKING_OPTIONS)
 
 
 # Categorize elements by type
@@ -47,32 +113,81 @@ def extract_texts(raw_pdf_elements):
     return texts
 
 
-def extract_tables(fpath, fname):
+def extract_tables(fpath, fname, pages='all'):
     logger.info(f"Extracting tables")
     # Use camelot to read tables from the PDF
-    tables = camelot.read_pdf(fpath + fname, flavor='stream', pages='all')
+    tables = camelot.read_pdf(os.path.join(fpath, fname), flavor='stream', pages=pages)
     dataframes = [table.df for table in tables]
 
     logger.info(f"Extracting tables complete")
     return dataframes
 
 
+def table_element_to_dataframe(element):
+    """
+    Build a DataFrame shaped like Camelot's output (string cells, header as the first row)
+    from an unstructured Table element.
+    """
+    html = getattr(element.metadata, "text_as_html", None)
+    if html:
+        try:
+            df = pd.read_html(io.StringIO(html))[0]
+            if not isinstance(df.columns, pd.RangeIndex):
+                header = pd.DataFrame([[str(column) for column in df.columns]], columns=df.columns)
+                df = pd.concat([header, df], ignore_index=True)
+                df.columns = range(df.shape[1])
+            return df.fillna("").astype(str)
+        except ValueError:
+            logger.info("Could not parse table html, falling back to the table text")
+    return pd.DataFrame([[line] for line in str(element).splitlines()])
+
+
+def extract_tables_from_elements(raw_pdf_elements, fpath, fname, camelot_fallback=TABLE_CAMELOT_FALLBACK):
+    """
+    Build tables from the Table elements partition_pdf already produced.
+    Camelot only parses the pages where unstructured found no table.
+    """
+    logger.info(f"Extracting tables from elements")
+    page_tables = []
+    table_pages = set()
+    for element in raw_pdf_elements:
+        if element.category == "Table":
+            page_number = element.metadata.page_number or 0
+            table_pages.add(page_number)
+            page_tables.append((page_number, table_element_to_dataframe(element)))
+
+    if camelot_fallback:
+        page_count = len(PdfReader(os.path.join(fpath, fname)).pages)
+        remaining_pages = [page for page in range(1, page_count + 1) if page not in table_pages]
+        if remaining_pages:
+            for table in camelot.read_pdf(os.path.join(fpath, fname), flavor='stream',
+                                          pages=",".join(str(page) for page in remaining_pages)):
+                page_tables.append((int(table.page), table.df))
+
+    # Keep tables in page order, the way a single Camelot pass returns them
+    page_tables.sort(key=lambda page_table: page_table[0])
+    logger.info(f"Extracting tables from elements complete")
+    return [df for _, df in page_tables]
+
+
 def extract_images(img_path):
+    """
+    Returns the paths of the .jpg images in img_path, they are read one at a time when they are encoded
+    so their pixels are not held in memory
+    """
     images = []
     # iterate over files in directory
     logger.info(f"Extracting images")
     if os.path.exists(img_path):
         for filename in os.listdir(img_path):
             if filename.endswith(".jpg"):
-                img = Image.open(os.path.join(img_path, filename))
-                images.append(img)
+                images.append(os.path.join(img_path, filename))
     logger.info(f"Extracting images complete")
     return images
 
 
 def semantic_chunking_texts(texts):
-    semantic_chunker = SemanticChunker(OpenAIEmbeddings(model="text-embedding-3-small"),
-                                       breakpoint_threshold_type="percentile")
+    semantic_chunker = SemanticChunker(get_embeddings(), breakpoint_threshold_type="percentile")
     semantic_chunks = semantic_chunker.create_documents(texts)
     semantic_text_chunks = [doc.page_content for doc in semantic_chunks]
     return semantic_text_chunks
@@ -84,36 +199,363 @@ def convert_tables_to_json(tables):
     return json_tables
 
 
-def process_pdf(file_path, file_name, index_name, file_id):
+def get_content_registry():
+    return ContentRegistry(db_url=os.getenv("POSTGRES_CONNECTION_STRING"))
+
+
+def index_registered_content(entry, index_name, file_id):
+    """
+    Index a file whose bytes were ingested before, reusing the stored contents, summaries and embeddings.
+    entry: Registry entry returned by ContentRegistry.get
+    """
+    logger.info(f"Indexing file '{file_id}' from the content registry")
+    create_multi_vector_retriever(
+        entry["text"]["summaries"],
+        entry["text"]["contents"],
+        entry["table"]["summaries"],
+        entry["table"]["contents"],
+        entry["image"]["summaries"],
+        entry["image"]["contents"],
+        index_name,
+        file_id,
+        summary_embeddings={kind: entry[kind]["embeddings"] for kind in entry}
+    )
+
+
+def image_digests(img_path):
+    digests = set()
+    if os.path.exists(img_path):
+        for filename in os.listdir(img_path):
+            if filename.endswith(".jpg"):
+                digests.add(content_digest(encode_image(os.path.join(img_path, filename))))
+    return digests
+
+
+def read_image_files(img_path):
+    """
+    Returns {file name: bytes} of the .jpg files in img_path
+    """
+    images = {}
+    if os.path.exists(img_path):
+        for filename in os.listdir(img_path):
+            if filename.endswith(".jpg"):
+                with open(os.path.join(img_path, filename), "rb") as image_file:
+                    images[filename] = image_file.read()
+    return images
+
+
+def write_image_files(images, img_path):
+    os.makedirs(img_path, exist_ok=True)
+    for filename, data in images.items():
+        with open(os.path.join(img_path, filename), "wb") as image_file:
+            image_file.write(data)
+
+
+def load_checkpoints(job_id, content_hash):
+    """
+    Returns {stage: output} of the job's completed stages, empty when the job has none or they were made
+    from other bytes, e.g. the file changed in Drive since the failed attempt
+    """
+    checkpoints = get_checkpoint_store().load(job_id)
+    if checkpoints and checkpoints.get('source') != content_hash:
+        # Windows of a windowed job are sub-jobs, cleared with it
+        logger.info(f"Discarding checkpoints of job {job_id}, the file changed")
+        get_checkpoint_store().clear(job_id)
+        checkpoints = {}
+    if checkpoints:
+        logger.info(f"Resuming job {job_id} after stages {sorted(checkpoints)}")
+    else:
+        get_checkpoint_store().save(job_id, 'source', content_hash)
+    return checkpoints
+
+
+def merge_window_metrics(metrics, window_metrics, first_page):
+    """
+    Add up the stage records of a window, first_page is the index of the window's first page
+    """
+    metrics['windows'] = metrics.get('windows', 0) + 1
+    for stage, record in window_metrics.get('stages', {}).items():
+        total = metrics.setdefault('stages', {}).setdefault(
+            stage, {'wall_seconds': 0, 'cpu_seconds': 0, 'children_cpu_seconds': 0, 'items': 0})
+        for key in ('wall_seconds', 'cpu_seconds', 'children_cpu_seconds'):
+            total[key] = round(total[key] + record[key], 3)
+        total['items'] += record.get('items', 0)
+        for key in ('peak_rss_bytes', 'process_peak_rss_bytes', 'children_peak_rss_bytes'):
+            total[key] = max(total.get(key, 0), record[key])
+    for key in ('fast_pages', 'hi_res_pages'):
+        if key in window_metrics:
+            metrics.setdefault(key, []).extend(page + first_page for page in window_metrics[key])
+    for key in ('extraction', 'resumed_stages'):
+        if key in window_metrics:
+            metrics[key] = window_metrics[key]
+
+
+def process_pdf_windowed(file_path, file_name, index_name, file_id, window_pages, on_stage=None, metrics=None,
+                         content_hash=None, incremental=False, job_id=None):
+    """
+    Run process_pdf on consecutive windows of window_pages pages of a PDF. Every window is indexed and its
+    work directory removed before the next one is written, finished windows are not redone when the job resumes.
+    The content registry is not filled, that would need every window's results at once.
+    """
+    pdf_path = os.path.join(file_path, file_name)
+    page_count = len(PdfReader(pdf_path).pages)
+    windows = [(start, min(start + window_pages, page_count)) for start in range(0, page_count, window_pages)]
+    logger.info(f"Processing '{file_name}' in {len(windows)} windows of {window_pages} pages")
+
+    progress = load_checkpoints(job_id, content_hash).get('windows') if job_id else None
+    if progress is None:
+        # Items indexed before this job are compared against every window, removal waits for the last one
+        progress = {'done': 0, 'seen_digests': set(),
+                    'indexed': get_indexed_content(index_name, file_id) if incremental else None}
+        if job_id:
+            get_checkpoint_store().save(job_id, 'windows', progress)
+
+    for number, (start, end) in enumerate(windows):
+        if number < progress['done']:
+            continue
+        window_dir = os.path.join(file_path, f"window-{number:05d}")
+        os.makedirs(window_dir, exist_ok=True)
+        window_path, _, _ = write_shards(pdf_path, window_dir, [(start, end, None)])[0]
+        window_metrics = {}
+        process_pdf(window_dir, os.path.basename(window_path), index_name, file_id, on_stage=on_stage,
+                    metrics=window_metrics, content_hash=content_hash, incremental=incremental,
+                    job_id=f"{job_id}/window-{number:05d}" if job_id else None, window_pages=0,
+                    indexed_content=progress['indexed'], seen_digests=progress['seen_digests'])
+        shutil.rmtree(window_dir, ignore_errors=True)
+        if metrics is not None:
+            merge_window_metrics(metrics, window_metrics, start)
+        progress['done'] = number + 1
+        if job_id:
+            get_checkpoint_store().save(job_id, 'windows', progress)
+
+    if incremental:
+        indexed = progress['indexed']
+        removed = [record for digest, records in indexed.items() if digest not in progress['seen_digests']
+                   for record in records]
+        delete_indexed_content(index_name, removed)
+        if metrics is not None:
+            metrics['incremental'] = {
+                'added': metrics.get('stages', {}).get('upsert', {}).get('items', 0),
+                'removed': len(removed),
+                'unchanged': sum(len(records) for digest, records in indexed.items()
+                                 if digest in progress['seen_digests']),
+            }
+
+    if job_id:
+        get_checkpoint_store().clear(job_id)
+
+
+def process_pdf(file_path, file_name, index_name, file_id, on_stage=None, metrics=None, content_hash=None,
+                incremental=False, job_id=None, window_pages=PROCESS_WINDOW_PAGES, indexed_content=None,
+                seen_digests=None):
+    """
+    Run the ingestion pipeline for a downloaded PDF, DOCX or PPTX.
+    file_path: Job work directory holding the file, extracted images are written below it
+    on_stage: Optional callable invoked with a JobStage as each stage starts
+    metrics: Optional dict filled with the job's metrics, including a timing record per stage
+    content_hash: Digest of the file's bytes, the results are stored in the content registry under it unless
+    a window is processed, checkpoints made from other bytes are discarded
+    incremental: Update what is already indexed for file_id: only new or changed chunks, tables and images
+    are summarized and indexed, and only the ones no longer in the file are deleted
+    job_id: Optional id the output of every completed stage is checkpointed under, running the job again
+    with the same id resumes after the last completed stage
+    window_pages: PDFs with more pages are processed in windows of this many pages, 0 processes them whole
+    indexed_content: What get_indexed_content returned for file_id, when a window of an incremental update is
+    processed. Removal is then left to the caller, the digests of the window's items are added to seen_digests.
+    """
+    def report_stage(stage):
+        if on_stage:
+            on_stage(stage)
+
+    if window_pages and file_name.lower().endswith('.pdf') \
+            and len(PdfReader(os.path.join(file_path, file_name)).pages) > window_pages:
+        return process_pdf_windowed(file_path, file_name, index_name, file_id, window_pages, on_stage=on_stage,
+                                    metrics=metrics, content_hash=content_hash, incremental=incremental,
+                                    job_id=job_id)
+
+    checkpoints = {}
+    if job_id:
+        checkpoints = load_checkpoints(job_id, content_hash)
+        if metrics is not None:
+            metrics['resumed_stages'] = sorted(stage for stage in checkpoints if stage != 'source')
+
+    def checkpoint(stage, output):
+        if job_id:
+            get_checkpoint_store().save(job_id, stage, output)
+        return output
+
     # File path
     logger.info(f"In process pdf for file '{file_name}'")
-    img_path = "figures/"
+    img_path = os.path.join(file_path, "figures")
     # Get elements
-    raw_pdf_elements = extract_pdf_elements(file_path, file_name)
+    report_stage(JobStage.PARTITIONING)
+    if 'elements' in checkpoints:
+        partitioned = checkpoints['elements']
+        # The images, and the PDF a native extraction fell back to, only lived in the failed attempt's work directory
+        write_image_files(partitioned['images'], img_path)
+        converted_path = os.path.join(file_path, partitioned['file_name'])
+        if partitioned.get('converted') is not None and not os.path.exists(converted_path):
+            with open(converted_path, "wb") as converted_file:
+                converted_file.write(partitioned['converted'])
+    else:
+        raw_pdf_elements = None
+        converted = None
+        with measure_stage(metrics, 'partitioning') as stage:
+            if file_name.lower().endswith(tuple(NATIVE_OFFICE_EXTENSIONS.values())):
+                try:
+                    raw_pdf_elements = extract_office_elements(file_path, file_name, img_path)
+                    extraction = 'office_native'
+                except Exception as e:
+                    # Fall back to the PDF route
+                    logger.info(f"Native extraction of '{file_name}' failed, converting it to PDF: {e}")
+                    shutil.rmtree(img_path, ignore_errors=True)
+                    file_name = os.path.basename(convert_to_pdf(os.path.join(file_path, file_name)))
+                    # Kept with the elements, later stages read tables from the converted file
+                    with open(os.path.join(file_path, file_name), "rb") as converted_file:
+                        converted = converted_file.read()
+            if raw_pdf_elements is None:
+                raw_pdf_elements = extract_pdf_elements(file_path, file_name, img_path, metrics=metrics)
+                extraction = 'pdf'
+            stage['items'] = len(raw_pdf_elements)
+        partitioned = checkpoint('elements', {'elements': raw_pdf_elements, 'file_name': file_name,
+                                              'extraction': extraction, 'images': read_image_files(img_path),
+                                              'converted': converted})
+    raw_pdf_elements = partitioned['elements']
+    file_name = partitioned['file_name']
+    if metrics is not None:
+        metrics['extraction'] = partitioned['extraction']
+    is_pdf = file_name.lower().endswith('.pdf')
     # Get text, tables
+    report_stage(JobStage.EXTRACTING)
     texts = extract_texts(raw_pdf_elements)
-    tables = extract_tables(file_path, file_name)
-    images = extract_images(img_path)
-    chunked_texts = semantic_chunking_texts(texts)
+    if 'tables' in checkpoints:
+        tables = checkpoints['tables']
+    else:
+        with measure_stage(metrics, 'tables') as stage:
+            if TABLE_EXTRACTION_MODE == "camelot" and is_pdf:
+                tables = extract_tables(file_path, file_name)
+            else:
+                tables = extract_tables_from_elements(raw_pdf_elements, file_path, file_name,
+                                                      camelot_fallback=TABLE_CAMELOT_FALLBACK and is_pdf)
+            stage['items'] = len(tables)
+        checkpoint('tables', tables)
+    with measure_stage(metrics, 'images') as stage:
+        images = extract_images(img_path)
+        stage['items'] = len(images)
+    report_stage(JobStage.CHUNKING)
+    if 'chunks' in checkpoints:
+        chunks = checkpoints['chunks']
+    else:
+        with measure_stage(metrics, 'chunking') as stage:
+            chunked_texts = semantic_chunking_texts(texts)
+            stage['items'] = len(chunked_texts)
+        json_tables = convert_tables_to_json(tables)
+
+        indexed = {}
+        current = set()
+        removed = []
+        unchanged = 0
+        if incremental:
+            # Compare content digests with what is indexed for the file and keep only new or changed items
+            indexed = indexed_content if indexed_content is not None else get_indexed_content(index_name, file_id)
+            current = {content_digest(text) for text in chunked_texts} | \
+                      {content_digest(table) for table in json_tables} | image_digests(img_path)
+            if seen_digests is None:
+                removed = [record for digest, records in indexed.items() if digest not in current
+                           for record in records]
+            unchanged = sum(len(records) for digest, records in indexed.items() if digest in current)
+            new_texts = [text for text in chunked_texts if content_digest(text) not in indexed]
+            new_tables = [(table, json_table) for table, json_table in zip(tables, json_tables)
+                          if content_digest(json_table) not in indexed]
+            logger.info(f"Incremental update of '{file_id}': {len(new_texts)} of {len(chunked_texts)} chunks and "
+                        f"{len(new_tables)} of {len(tables)} tables changed, {len(removed)} items removed")
+            chunked_texts = new_texts
+            tables = [table for table, _ in new_tables]
+            json_tables = [json_table for _, json_table in new_tables]
+        # The comparison is kept too, a resumed job must not diff against vectors it wrote itself
+        chunks = checkpoint('chunks', {'texts': chunked_texts, 'tables': tables, 'json_tables': json_tables,
+                                       'indexed_digests': set(indexed), 'digests': current, 'removed': removed,
+                                       'unchanged': unchanged})
+    if seen_digests is not None:
+        seen_digests.update(chunks['digests'])
+    chunked_texts = chunks['texts']
+    tables = chunks['tables']
+    json_tables = chunks['json_tables']
 
     # Get text, table summaries
-    text_summaries, table_summaries = generate_text_and_table_summaries(
-        chunked_texts, tables, summarize_texts=True
-    )
+    report_stage(JobStage.SUMMARIZING)
+    if 'text_summaries' in checkpoints:
+        text_summaries, table_summaries = checkpoints['text_summaries']
+    else:
+        with measure_stage(metrics, 'text_summaries') as stage:
+            text_summaries, table_summaries = generate_text_and_table_summaries(
+                chunked_texts, tables, summarize_texts=True
+            )
+            stage['items'] = len(text_summaries) + len(table_summaries)
+        checkpoint('text_summaries', (text_summaries, table_summaries))
 
     # Image summaries
-    img_base64_list, image_summaries = generate_img_summaries(img_path)
-    json_tables = convert_tables_to_json(tables)
+    if 'image_summaries' in checkpoints:
+        img_base64_list, image_summaries = checkpoints['image_summaries']
+    else:
+        with measure_stage(metrics, 'image_summaries') as stage:
+            img_base64_list, image_summaries = generate_img_summaries(img_path, exclude=chunks['indexed_digests'])
+            stage['items'] = len(image_summaries)
+        checkpoint('image_summaries', (img_base64_list, image_summaries))
 
     logger.info(f"PDF extraction complete for file '{file_name}'")
     # Create retriever
-    retriever_multi_vector_img = create_multi_vector_retriever(
-        text_summaries,
-        chunked_texts,
-        table_summaries,
-        json_tables,
-        image_summaries,
-        img_base64_list,
-        index_name,
-        file_id
-    )
+    report_stage(JobStage.INDEXING)
+    if 'embeddings' in checkpoints:
+        summary_embeddings = checkpoints['embeddings']
+    else:
+        with measure_stage(metrics, 'embedding') as stage:
+            summary_embeddings = {
+                "text": embed_summaries(text_summaries),
+                "table": embed_summaries(table_summaries),
+                "image": embed_summaries(image_summaries),
+            }
+            stage['items'] = sum(len(vectors) for vectors in summary_embeddings.values())
+        checkpoint('embeddings', summary_embeddings)
+    with measure_stage(metrics, 'upsert') as stage:
+        # Ids derived from the job id make an upsert repeated by a resumed job overwrite the same records
+        retriever_multi_vector_img = create_multi_vector_retriever(
+            text_summaries,
+            chunked_texts,
+            table_summaries,
+            json_tables,
+            image_summaries,
+            img_base64_list,
+            index_name,
+            file_id,
+            summary_embeddings=summary_embeddings,
+            id_seed=job_id
+        )
+        stage['items'] = len(text_summaries) + len(table_summaries) + len(image_summaries)
+
+    if incremental and seen_digests is None:
+        delete_indexed_content(index_name, chunks['removed'])
+        if metrics is not None:
+            metrics['incremental'] = {
+                'added': len(chunked_texts) + len(json_tables) + len(img_base64_list),
+                'removed': len(chunks['removed']),
+                'unchanged': chunks['unchanged'],
+            }
+    elif content_hash and not incremental and seen_digests is None:
+        # Identical bytes uploaded later, into any channel, are indexed from these results.
+        # The file is already indexed, so a failed write only costs the reuse
+        try:
+            get_content_registry().put(content_hash, {
+                "text": {"contents": chunked_texts, "summaries": text_summaries,
+                         "embeddings": summary_embeddings["text"]},
+                "table": {"contents": json_tables, "summaries": table_summaries,
+                          "embeddings": summary_embeddings["table"]},
+                "image": {"contents": img_base64_list, "summaries": image_summaries,
+                          "embeddings": summary_embeddings["image"]},
+            })
+        except Exception as e:
+            logger.error(f"Error storing '{file_name}' in the content registry: {e}")
+
+    if job_id:
+        # Indexed, nothing left to resume
+        get_checkpoint_store().clear(job_id)
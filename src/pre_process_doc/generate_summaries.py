@@ -1,6 +1,6 @@
 import base64
 import os
-import shutil
+import threading
 
 from dotenv import load_dotenv
 from langchain_core.messages import HumanMessage
@@ -8,9 +8,77 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from logging_config import logger
+from PIL import Image
+
+from docstore.summary_cache import get_summary_cache
+from retriever import content_digest
+from summary_scheduler import get_summary_scheduler
 
 load_dotenv()
 
+TEXT_SUMMARY_MODEL = "gpt-4"
+IMAGE_SUMMARY_MODEL = "gpt-4o"
+# Images whose shorter side is below this many pixels are not summarized or stored
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "64"))
+# Images whose perceptual hashes differ in at most this many bits share one summary
+IMAGE_HASH_MAX_DISTANCE = int(os.getenv("IMAGE_HASH_MAX_DISTANCE", "4"))
+# Tokens budgeted for the image part of a vision request
+IMAGE_PROMPT_TOKENS = 1000
+
+
+def get_cached_summaries(cache, keys):
+    """
+    Returns {key: summary} for the cached keys, nothing when the cache can't be read
+    """
+    try:
+        return cache.mget(keys)
+    except Exception as e:
+        logger.error(f"Error reading the summary cache: {e}")
+        return {}
+
+
+def store_summaries(cache, entries):
+    """
+    Cache new summaries, a failed write only costs the reuse
+    """
+    try:
+        cache.mset(entries)
+    except Exception as e:
+        logger.error(f"Error writing {len(entries)} summaries to the summary cache: {e}")
+
+
+def summarize_with_cache(summarize_chain, elements, model_name, prompt_text):
+    """
+    Summarize elements, only calling the model for elements without a cached summary
+    Returns the summaries in the order of elements
+    """
+    cache = get_summary_cache()
+    # The prompt formats every element with str(), so that is the content the summary depends on
+    contents = [str(element) for element in elements]
+    keys = [cache.key(model_name, prompt_text, content) for content in contents]
+    summaries = get_cached_summaries(cache, keys)
+
+    # Elements repeated in the batch are summarized once
+    missing = {}
+    for i, key in enumerate(keys):
+        if key not in summaries and key not in missing:
+            missing[key] = i
+    if missing:
+        # Calls run concurrently under the model's rate limits, results come back in input order
+        results = get_summary_scheduler(model_name).map(
+            summarize_chain.invoke,
+            [elements[i] for i in missing.values()],
+            [prompt_text + contents[i] for i in missing.values()]
+        )
+        entries = []
+        for (key, i), summary in zip(missing.items(), results):
+            summaries[key] = summary
+            entries.append((key, model_name, prompt_text, contents[i], summary))
+        store_summaries(cache, entries)
+    logger.info(f"Summary cache: {len(elements) - len(missing)} of {len(elements)} summaries cached, "
+                f"totals {cache.stats()}")
+    return [summaries[key] for key in keys]
+
 
 # Generate summaries of text elements
 def generate_text_and_table_summaries(texts, tables, summarize_texts=False):
@@ -30,7 +98,9 @@ def generate_text_and_table_summaries(texts, tables, summarize_texts=False):
     prompt = ChatPromptTemplate.from_template(prompt_text)
     logger.info(f"Generating summaries")
     # Text summary chain
-    model = ChatOpenAI(temperature=0, model="gpt-4", openai_api_key=os.getenv("OPENAI_API_KEY"))
+    # 429s, connection errors and 5xx are retried by the summary scheduler, which backs off all calls on a 429
+    model = ChatOpenAI(temperature=0, model=TEXT_SUMMARY_MODEL, openai_api_key=os.getenv("OPENAI_API_KEY"),
+                       max_retries=0)
     summarize_chain = {"element": lambda x: x} | prompt | model | StrOutputParser()
     # Initialize empty summaries
     text_summaries = []
@@ -38,12 +108,12 @@ def generate_text_and_table_summaries(texts, tables, summarize_texts=False):
 
     # Apply to text if texts are provided and summarization is requested
     if texts and summarize_texts:
-        text_summaries = summarize_chain.batch(texts, {"max_concurrency": 1})
+        text_summaries = summarize_with_cache(summarize_chain, texts, TEXT_SUMMARY_MODEL, prompt_text)
     elif texts:
         text_summaries = texts
     # Apply to tables if tables are provided
     if tables:
-        table_summaries = summarize_chain.batch(tables, {"max_concurrency": 1})
+        table_summaries = summarize_with_cache(summarize_chain, tables, TEXT_SUMMARY_MODEL, prompt_text)
 
     logger.info(f"Generating summaries complete")
     return text_summaries, table_summaries
@@ -55,10 +125,24 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode("utf-8")
 
 
+_image_model = None
+_image_model_lock = threading.Lock()
+
+
+def get_image_model():
+    """One vision client reused by every image summary"""
+    global _image_model
+    with _image_model_lock:
+        if _image_model is None:
+            # 429s, connection errors and 5xx are retried by the summary scheduler
+            _image_model = ChatOpenAI(model=IMAGE_SUMMARY_MODEL, openai_api_key=os.getenv("OPENAI_API_KEY"),
+                                      max_retries=0)
+        return _image_model
+
+
 def image_summarize(img_base64, prompt):
-    logger.info(f"Generating image summaries")
     """Make image summary"""
-    chat = ChatOpenAI(model="gpt-4o", openai_api_key=os.getenv("OPENAI_API_KEY"))
+    chat = get_image_model()
 
     msg = chat.invoke(
         [
@@ -76,24 +160,41 @@ def image_summarize(img_base64, prompt):
     return msg.content
 
 
-def delete_folder_relative(folder_name):
-    folder_path = os.path.join(os.path.dirname(__file__), folder_name)
+def perceptual_hash(img):
+    """
+    64 bit difference hash, near identical images differ in only a few bits
+    """
+    pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(8):
+        for col in range(8):
+            image_hash = (image_hash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return image_hash
+
 
-    if os.path.exists(folder_path):
-        try:
-            # Use shutil.rmtree() to delete the folder and its contents
-            shutil.rmtree(folder_path)
-        except Exception as e:
-            print(f"Error deleting folder: {e}")
-    else:
-        print(f"Folder does not exist: {folder_path}")
+def group_near_duplicates(hashes, max_distance=IMAGE_HASH_MAX_DISTANCE):
+    """
+    Returns, for every hash, the index of the first hash within max_distance bits of it
+    """
+    representatives = []
+    unique = []
+    for i, image_hash in enumerate(hashes):
+        for j in unique:
+            if bin(image_hash ^ hashes[j]).count("1") <= max_distance:
+                representatives.append(j)
+                break
+        else:
+            unique.append(i)
+            representatives.append(i)
+    return representatives
 
 
-def generate_img_summaries(path):
+def generate_img_summaries(path, exclude=None):
     logger.info(f"Generating image summaries")
     """
     Generate summaries and base64 encoded strings for images
-    path: Path to list of .jpg files extracted by Unstructured
+    path: Job directory holding the .jpg files extracted by Unstructured, removed by the job afterwards
+    exclude: Optional set of content digests of images to leave out, e.g. images already indexed
     """
 
     # Store base64 encoded images
@@ -102,8 +203,8 @@ def generate_img_summaries(path):
     # Store image summaries
     image_summaries = []
 
-    # Delete the figures folder after it has been converted base64
-    folder_to_delete = "figures"
+    # Perceptual hash of every kept image
+    hashes = []
 
     # Prompt
     prompt = """You are an assistant tasked with summarizing images for retrieval. \
@@ -111,14 +212,46 @@ def generate_img_summaries(path):
     Give a very detailed summary of the image such that when a user asks any question \
     about the image, we should be able to derive the answer from the image summary. """
 
-    # Apply to images
-    for img_file in sorted(os.listdir(path)):
+    # Apply to images, skipping logos, dividers and other ornaments too small to carry content
+    img_files = sorted(os.listdir(path)) if os.path.exists(path) else []
+    for img_file in img_files:
         if img_file.endswith(".jpg"):
             img_path = os.path.join(path, img_file)
+            with Image.open(img_path) as img:
+                if min(img.size) < IMAGE_MIN_SIDE:
+                    logger.info(f"Skipping image {img_file} of size {img.size}")
+                    continue
+                image_hash = perceptual_hash(img)
             base64_image = encode_image(img_path)
+            if exclude and content_digest(base64_image) in exclude:
+                continue
+            hashes.append(image_hash)
             img_base64_list.append(base64_image)
-            image_summaries.append(image_summarize(base64_image, prompt))
 
-    delete_folder_relative(folder_to_delete)
+    # Near duplicates, e.g. an ornament repeated on every page, reuse their representative's summary
+    representatives = group_near_duplicates(hashes)
+    unique = sorted(set(representatives))
+
+    # Only representatives without a cached summary go to the model
+    cache = get_summary_cache()
+    keys = {i: cache.key(IMAGE_SUMMARY_MODEL, prompt, img_base64_list[i]) for i in unique}
+    cached_summaries = get_cached_summaries(cache, list(keys.values()))
+    missing = [i for i in unique if keys[i] not in cached_summaries]
+    if missing:
+        results = get_summary_scheduler(IMAGE_SUMMARY_MODEL).map(
+            lambda base64_image: image_summarize(base64_image, prompt),
+            [img_base64_list[i] for i in missing],
+            [prompt] * len(missing),
+            extra_tokens=IMAGE_PROMPT_TOKENS
+        )
+        entries = []
+        for i, summary in zip(missing, results):
+            cached_summaries[keys[i]] = summary
+            entries.append((keys[i], IMAGE_SUMMARY_MODEL, prompt, img_base64_list[i], summary))
+        store_summaries(cache, entries)
+    image_summaries = [cached_summaries[keys[i]] for i in representatives]
+    logger.info(f"{len(img_base64_list)} images, {len(unique)} distinct, {len(missing)} summarized by the model, "
+                f"summary cache totals {cache.stats()}")
+
     logger.info(f"Generating image summaries complete")
     return img_base64_list, image_summaries
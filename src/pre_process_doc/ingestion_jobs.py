@@ -0,0 +1,128 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+from logging_config import logger
+
+# Number of files ingested at the same time by this container
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+# Files downloaded at the same time, ahead of the jobs that process them
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "4"))
+# Files downloaded but not yet being processed, bounds the temporary files waiting on disk
+PREFETCH_MAX = int(os.getenv("PREFETCH_MAX", str(2 * INGESTION_WORKERS)))
+# Jobs accepted (running + waiting) before /process-files starts rejecting requests
+INGESTION_MAX_PENDING = int(os.getenv("INGESTION_MAX_PENDING", "100"))
+
+
+class JobStage(Enum):
+    QUEUED = "QUEUED"
+    DOWNLOADING = "DOWNLOADING"
+    PARTITIONING = "PARTITIONING"
+    EXTRACTING = "EXTRACTING"
+    CHUNKING = "CHUNKING"
+    SUMMARIZING = "SUMMARIZING"
+    INDEXING = "INDEXING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+_executor = ThreadPoolExecutor(max_workers=INGESTION_WORKERS, thread_name_prefix="ingest")
+_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+_prefetch_slots = threading.BoundedSemaphore(PREFETCH_MAX)
+_lock = threading.Lock()
+# job_id -> doc_id for every job accepted by this process that has not finished yet
+_active_jobs = {}
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def active_job_for_document(doc_id):
+    with _lock:
+        for job_id, active_doc_id in _active_jobs.items():
+            if active_doc_id == doc_id:
+                return job_id
+    return None
+
+
+def active_job_ids():
+    with _lock:
+        return list(_active_jobs)
+
+
+def reserve_job(job_id, doc_id):
+    """
+    Take a place in the queue for a job before anything is recorded about it, submit_job then uses it.
+    Raises JobQueueFull when too many jobs are already waiting.
+    """
+    with _lock:
+        if job_id in _active_jobs:
+            return
+        if len(_active_jobs) >= INGESTION_MAX_PENDING:
+            raise JobQueueFull(f"{len(_active_jobs)} ingestion jobs already pending")
+        _active_jobs[job_id] = doc_id
+
+
+def release_job(job_id):
+    """
+    Give back the place of a reserved job that won't be submitted
+    """
+    with _lock:
+        _active_jobs.pop(job_id, None)
+
+
+def submit_job(job_id, doc_id, fn, *args, fetch=None):
+    """
+    Run fn(job_id, *args) on the ingestion worker pool.
+    fetch: Optional callable run on the fetch pool as fetch(job_id), its Future is passed to fn as fetch_future,
+    so downloads overlap with the processing of files queued earlier. A fetch waits for one of PREFETCH_MAX slots,
+    released when its job starts processing, unless the job starts first.
+    Raises JobQueueFull when too many jobs are already waiting, unless the job was reserved.
+    """
+    reserve_job(job_id, doc_id)
+
+    started = threading.Event()
+    slot_lock = threading.Lock()
+    slot = {'held': False}
+
+    def prefetch():
+        # Poll so a fetch whose job already started, and is waiting on it, doesn't wait for a slot
+        while not started.is_set():
+            if _prefetch_slots.acquire(timeout=1):
+                with slot_lock:
+                    if started.is_set():
+                        _prefetch_slots.release()
+                    else:
+                        slot['held'] = True
+                break
+        return fetch(job_id)
+
+    kwargs = {}
+    if fetch is not None:
+        kwargs['fetch_future'] = _fetch_executor.submit(prefetch)
+
+    def run():
+        with slot_lock:
+            started.set()
+            if slot['held']:
+                _prefetch_slots.release()
+                slot['held'] = False
+        try:
+            fn(job_id, *args, **kwargs)
+        except Exception as e:
+            logger.info(f"Ingestion job {job_id} crashed")
+            logger.info(e)
+        finally:
+            with _lock:
+                _active_jobs.pop(job_id, None)
+
+    _executor.submit(run)
+    logger.info(f"Queued ingestion job {job_id} for document {doc_id}")
+    return job_id
@@ -0,0 +1,214 @@
+import multiprocessing
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader, PdfWriter
+from unstructured.chunking.title import chunk_by_title
+from unstructured.partition.pdf import partition_pdf
+
+from logging_config import logger
+
+# Worker processes used to partition one PDF, 1 keeps the single process path.
+# Check the sharded path against it with check_partition_parity.py before raising this
+PARTITION_WORKERS = int(os.getenv("PARTITION_WORKERS", "1"))
+# Pages handed to each worker process
+PARTITION_PAGES_PER_SHARD = int(os.getenv("PARTITION_PAGES_PER_SHARD", "20"))
+# Set to true to partition pages with a text layer with the fast strategy and only the rest with hi_res.
+# fast pages get no table structure inference, so their tables only come from the Camelot pass over pages
+# without Table elements (TABLE_CAMELOT_FALLBACK in extraction.py); with that pass disabled their tables are
+# indexed as plain text. Off by default, hi_res on every page keeps unstructured's table detection everywhere.
+PARTITION_STRATEGY_PER_PAGE = os.getenv("PARTITION_STRATEGY_PER_PAGE", "false").lower() in ['true', '1', 't', 'y',
+                                                                                           'yes']
+# Characters of extractable text a page needs before it is partitioned with the fast strategy
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+
+FAST = "fast"
+HI_RES = "hi_res"
+
+# by_title chunking settings shared by the single process and sharded paths
+CHUNKING_OPTIONS = {
+    "max_characters": 4000,
+    "new_after_n_chars": 3800,
+    "combine_text_under_n_chars": 2000,
+}
+
+# Unstructured names extracted images <figure|table>-<page>-<running number>.jpg
+IMAGE_NAME_PATTERN = re.compile(r"^(?P<kind>[a-z]+)-(?P<page>\d+)-(?P<number>\d+)\.(?P<ext>\w+)$")
+
+
+def partition_pdf_single(pdf_path, img_path):
+    return partition_pdf(
+        filename=pdf_path,
+        strategy=HI_RES,
+        extract_images_in_pdf=True,
+        infer_table_structure=True,
+        chunking_strategy="by_title",
+        image_output_dir_path=img_path,
+        extract_image_block_output_dir=img_path,
+        **CHUNKING_OPTIONS,
+    )
+
+
+def detect_page_strategies(pdf_path, min_chars=TEXT_LAYER_MIN_CHARS):
+    """
+    Pick a partition strategy for every page: fast for pages with an extractable text layer,
+    hi_res for scanned or image only pages.
+    """
+    strategies = []
+    for page in PdfReader(pdf_path).pages:
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            text = ""
+        strategies.append(FAST if len(text.strip()) >= min_chars else HI_RES)
+    return strategies
+
+
+def page_strategy_metrics(strategies):
+    return {
+        "fast_pages": [page + 1 for page, strategy in enumerate(strategies) if strategy == FAST],
+        "hi_res_pages": [page + 1 for page, strategy in enumerate(strategies) if strategy == HI_RES],
+    }
+
+
+def plan_shards(strategies, pages_per_shard):
+    """
+    Group consecutive pages sharing a strategy into runs of at most pages_per_shard pages.
+    Returns a list of (first page index, end page index, strategy).
+    """
+    plan = []
+    start = 0
+    for page in range(1, len(strategies) + 1):
+        if page == len(strategies) or strategies[page] != strategies[start] or page - start >= pages_per_shard:
+            plan.append((start, page, strategies[start]))
+            start = page
+    return plan
+
+
+def write_shards(pdf_path, shard_dir, plan):
+    """
+    Write every planned page range out as its own PDF.
+    Returns a list of (shard file path, index of the shard's first page, strategy) in page order.
+    """
+    reader = PdfReader(pdf_path)
+    shards = []
+    for start, end, strategy in plan:
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        shard_path = os.path.join(shard_dir, f"shard-{start:05d}.pdf")
+        with open(shard_path, "wb") as f:
+            writer.write(f)
+        shards.append((shard_path, start, strategy))
+    return shards
+
+
+def save_embedded_images(pdf_path, img_path):
+    """
+    Save the images embedded in a PDF as .jpg files, named the way unstructured names extracted images.
+    The fast strategy does not extract images itself.
+    """
+    os.makedirs(img_path, exist_ok=True)
+    number = 1
+    for page_number, page in enumerate(PdfReader(pdf_path).pages, start=1):
+        try:
+            page_images = list(page.images)
+        except Exception as e:
+            logger.info(f"Could not read images of page {page_number}: {e}")
+            continue
+        for embedded in page_images:
+            try:
+                embedded.image.convert("RGB").save(os.path.join(img_path, f"figure-{page_number}-{number}.jpg"))
+                number += 1
+            except Exception as e:
+                logger.info(f"Could not save image '{embedded.name}' of page {page_number}: {e}")
+
+
+def partition_pdf_shard(shard_path, page_offset, shard_img_path, strategy=HI_RES):
+    """
+    Partition one page range without chunking, runs in a worker process.
+    Page numbers are shifted so they refer to pages of the original PDF.
+    """
+    if strategy == FAST:
+        elements = partition_pdf(filename=shard_path, strategy=FAST)
+        save_embedded_images(shard_path, shard_img_path)
+    else:
+        elements = partition_pdf(
+            filename=shard_path,
+            strategy=HI_RES,
+            extract_images_in_pdf=True,
+            infer_table_structure=True,
+            image_output_dir_path=shard_img_path,
+            extract_image_block_output_dir=shard_img_path,
+        )
+    for element in elements:
+        if element.metadata.page_number is not None:
+            element.metadata.page_number += page_offset
+    return elements
+
+
+def merge_shard_images(shard_img_path, page_offset, img_path, next_number):
+    """
+    Move a shard's images into img_path under the names a single process run would have given them.
+    Returns the next running image number and a map of old to new image paths.
+    """
+    if not os.path.exists(shard_img_path):
+        return next_number, {}
+    renamed = {}
+    images = []
+    for img_file in os.listdir(shard_img_path):
+        match = IMAGE_NAME_PATTERN.match(img_file)
+        if match:
+            images.append((int(match.group("number")), img_file, match))
+    for _, img_file, match in sorted(images):
+        page = int(match.group("page")) + page_offset
+        new_name = f"{match.group('kind')}-{page}-{next_number}.{match.group('ext')}"
+        shutil.move(os.path.join(shard_img_path, img_file), os.path.join(img_path, new_name))
+        renamed[os.path.join(shard_img_path, img_file)] = os.path.join(img_path, new_name)
+        next_number += 1
+    shutil.rmtree(shard_img_path, ignore_errors=True)
+    return next_number, renamed
+
+
+def partition_pdf_sharded(pdf_path, img_path, workers, strategies=None, pages_per_shard=PARTITION_PAGES_PER_SHARD):
+    """
+    Partition page ranges of the PDF, in a process pool when workers > 1, then merge the elements back
+    in page order and chunk them by title across the shard boundaries.
+    strategies: Partition strategy for every page, hi_res for all pages when not given
+    """
+    if strategies is None:
+        strategies = [HI_RES] * len(PdfReader(pdf_path).pages)
+    shard_dir = os.path.join(os.path.dirname(pdf_path), "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    os.makedirs(img_path, exist_ok=True)
+    try:
+        shards = write_shards(pdf_path, shard_dir, plan_shards(strategies, pages_per_shard))
+        shard_args = [
+            (shard_path, page_offset, os.path.join(shard_dir, f"figures-{page_offset:05d}"), strategy)
+            for shard_path, page_offset, strategy in shards
+        ]
+        if workers > 1:
+            logger.info(f"Partitioning {len(shards)} shards of '{pdf_path}' on {workers} processes")
+            # spawn rather than fork, the upload service forks from a multi-threaded process
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=min(workers, len(shards)) or 1, mp_context=context) as executor:
+                futures = [executor.submit(partition_pdf_shard, *args) for args in shard_args]
+                shard_elements = [future.result() for future in futures]
+        else:
+            logger.info(f"Partitioning {len(shards)} shards of '{pdf_path}'")
+            shard_elements = [partition_pdf_shard(*args) for args in shard_args]
+
+        elements = []
+        next_number = 1
+        for (_, page_offset, shard_img_path, _), shard in zip(shard_args, shard_elements):
+            next_number, renamed = merge_shard_images(shard_img_path, page_offset, img_path, next_number)
+            for element in shard:
+                if getattr(element.metadata, "image_path", None) in renamed:
+                    element.metadata.image_path = renamed[element.metadata.image_path]
+            elements.extend(shard)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    return chunk_by_title(elements, **CHUNKING_OPTIONS)
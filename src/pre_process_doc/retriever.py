@@ -1,18 +1,62 @@
+import base64
+import hashlib
+import io
 import os
+import threading
 import uuid
 
+from langchain.embeddings import CacheBackedEmbeddings
 from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
 from logging_config import logger
+from PIL import Image
 from pinecone import Pinecone, ServerlessSpec
 
 # Local Python files
+from docstore.embedding_store import SQLAlchemyByteStore
 from docstore.sqlalchemy_docstore import SQLAlchemyDocStore
+from vector_writer import VECTOR_BACKEND, get_memory_index, upsert_vectors
 
 
-def get_vectorestore(index_name):
+EMBEDDING_MODEL = 'text-embedding-3-small'
+# Kind and MIME type the docstore records for text chunks and tables, tables are stored as JSON records
+CONTENT_ATTRIBUTES = {
+    "text": {"kind": "text", "content_type": "text/plain"},
+    "table": {"kind": "table", "content_type": "application/json"},
+}
+# Size images are sent to the chat model at, their rendition is stored with them at ingestion
+PROMPT_IMAGE_SIZE = (1300, 600)
+# Texts per embeddings request for cache misses
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "500"))
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings():
+    """
+    Embeddings shared by semantic chunking and the Pinecone upserts, texts embedded before are
+    read from the embedding cache instead of the OpenAI API
+    """
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            _embeddings = CacheBackedEmbeddings.from_bytes_store(
+                OpenAIEmbeddings(
+                    model=EMBEDDING_MODEL,
+                    openai_api_key=os.getenv("OPENAI_API_KEY")
+                ),
+                SQLAlchemyByteStore(),
+                namespace=EMBEDDING_MODEL,
+                batch_size=EMBEDDING_BATCH_SIZE,
+            )
+        return _embeddings
+
+
+def get_index(index_name):
+    if VECTOR_BACKEND == "memory":
+        return get_memory_index(index_name)
     pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
     indexes = pc.list_indexes().names()
     logger.info("Indexes: ")
@@ -22,7 +66,7 @@ def get_vectorestore(index_name):
         index = pc.Index(index_name)
     else:
         # Create the index in case it doesn't exist
-        logger.info("Pinecone index not found, creating one: ", index_name)
+        logger.info(f"Pinecone index not found, creating one: {index_name}")
         pc.create_index(
             name=index_name,
             dimension=1536,
@@ -33,28 +77,107 @@ def get_vectorestore(index_name):
             )
         )
         index = pc.Index(index_name)
+    return index
 
-    model_name = 'text-embedding-3-small'
 
-    embed = OpenAIEmbeddings(
-        model=model_name,
-        openai_api_key=os.getenv("OPENAI_API_KEY")
-    )
+def get_vectorestore(index_name):
+    get_index(index_name)
 
     # Instantiate Pinecone vectorstore
-    vectorstore = PineconeVectorStore(index_name=index_name, embedding=embed)
+    vectorstore = PineconeVectorStore(index_name=index_name, embedding=get_embeddings())
 
     return vectorstore
 
 
+def content_digest(content):
+    """
+    Digest identifying a stored text chunk, JSON table or base64 image
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def image_document(base64_image):
+    """
+    Returns the bytes of a base64 encoded image and the docstore attributes stored with them:
+    the MIME type and the prompt sized rendition
+    """
+    data = base64.b64decode(base64_image)
+    with Image.open(io.BytesIO(data)) as img:
+        image_format = img.format
+        resized = img.resize(PROMPT_IMAGE_SIZE, Image.LANCZOS)
+    buffered = io.BytesIO()
+    resized.save(buffered, format=image_format)
+    return data, {"kind": "image", "content_type": Image.MIME.get(image_format, "application/octet-stream"),
+                  "rendition": buffered.getvalue()}
+
+
+def get_indexed_content(index_name, file_id):
+    """
+    Everything indexed for file_id, as {content digest: [(vector id, doc_id), ...]}.
+    Vectors whose docstore row is missing are listed under None.
+    """
+    index = get_index(index_name)
+    matches = index.query(
+        vector=[0] * 1536,  # A dummy vector since we only need metadata filtering
+        filter={"file_id": {"$eq": file_id}},
+        top_k=10000,
+        include_metadata=True
+    )['matches']
+    docstore = SQLAlchemyDocStore(db_url=os.getenv("POSTGRES_CONNECTION_STRING"), namespace=index_name)
+    contents = docstore.mget(list({match['metadata']['doc_id'] for match in matches}))
+    indexed = {}
+    for match in matches:
+        doc_id = match['metadata']['doc_id']
+        digest = None
+        if doc_id in contents:
+            content = contents[doc_id][0]
+            # Images are stored as bytes, the pipeline identifies them by their base64 encoding
+            digest = content_digest(base64.b64encode(content).decode("utf-8") if isinstance(content, bytes)
+                                    else content)
+        indexed.setdefault(digest, []).append((match['id'], doc_id))
+    return indexed
+
+
+def delete_indexed_content(index_name, records):
+    """
+    Delete vectors and their docstore rows
+    records: List of (vector id, doc_id)
+    """
+    if not records:
+        return
+    index = get_index(index_name)
+    vector_ids = [vector_id for vector_id, _ in records]
+    for start in range(0, len(vector_ids), 1000):
+        index.delete(ids=vector_ids[start:start + 1000])
+    docstore = SQLAlchemyDocStore(db_url=os.getenv("POSTGRES_CONNECTION_STRING"), namespace=index_name)
+    docstore.mdelete(list({doc_id for _, doc_id in records}))
+    logger.info(f"Deleted {len(vector_ids)} vectors and their docstore rows")
+
+
+def embed_summaries(summaries):
+    """
+    Embed summaries the way the vectorstore would, so the vectors can be kept and reused
+    """
+    if not summaries:
+        return []
+    return get_embeddings().embed_documents(summaries)
+
+
 def create_multi_vector_retriever(
-        text_summaries, texts, table_summaries, tables, image_summaries, images, index_name, file_id
+        text_summaries, texts, table_summaries, tables, image_summaries, images, index_name, file_id,
+        summary_embeddings=None, id_seed=None
 ):
     """
     Create retriever that indexes summaries, but returns raw images or texts
+    summary_embeddings: Optional dict of precomputed summary vectors keyed by "text", "table" and "image",
+    summaries without vectors are embedded here
+    id_seed: Optional string the vector and docstore ids are derived from instead of being random,
+    so indexing the same items again with the same seed overwrites them
     """
+    summary_embeddings = summary_embeddings or {}
     # Pinecone vectorstore
-    vectorstore = get_vectorestore(index_name)
+    index = get_index(index_name)
+    vectorstore = PineconeVectorStore(index=index, embedding=get_embeddings())
     COLLECTION_NAME = index_name
 
     postgres_docstore = SQLAlchemyDocStore(db_url=os.getenv("POSTGRES_CONNECTION_STRING"), namespace=COLLECTION_NAME)
@@ -70,28 +193,47 @@ def create_multi_vector_retriever(
     )
 
     # Helper function to add documents to the vectorstore and docstore
-    def add_documents(local_retriever, doc_summaries, doc_contents, local_file_id):
-        doc_ids = [str(uuid.uuid4()) for _ in doc_contents]
-        documents = [
-            (doc_ids[i], doc_contents[i], {"file_id": file_id})
-            for i in range(len(doc_contents))
-        ]
-        summary_docs = [
-            Document(page_content=s, metadata={id_key: doc_ids[i], "file_id": local_file_id})
+    def new_id(kind, position, record):
+        if id_seed is None:
+            return str(uuid.uuid4())
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{id_seed}/{kind}/{position}/{record}"))
+
+    def add_documents(local_retriever, doc_summaries, doc_contents, local_file_id, embeddings, kind):
+        doc_ids = [new_id(kind, i, "doc") for i in range(len(doc_contents))]
+        if kind == "image":
+            # Stored as binary with a rendition, so the chat service does no image work per query
+            documents = []
+            for i in range(len(doc_contents)):
+                data, attributes = image_document(doc_contents[i])
+                documents.append((doc_ids[i], data, {"file_id": file_id}, attributes))
+        else:
+            documents = [
+                (doc_ids[i], doc_contents[i], {"file_id": file_id}, CONTENT_ATTRIBUTES[kind])
+                for i in range(len(doc_contents))
+            ]
+        if not embeddings:
+            embeddings = embed_summaries(doc_summaries)
+        # Same record layout PineconeVectorStore.add_documents writes, the summary goes in the "text" field
+        vectors = [
+            {
+                "id": new_id(kind, i, "vector"),
+                "values": embeddings[i],
+                "metadata": {"text": s, id_key: doc_ids[i], "file_id": local_file_id},
+            }
             for i, s in enumerate(doc_summaries)
         ]
-        local_retriever.vectorstore.add_documents(summary_docs)
+        upsert_vectors(index, vectors)
         local_retriever.docstore.mset(documents)
 
     # Add texts, tables, and images
     # Check that text_summaries is not empty before adding
     if text_summaries:
-        add_documents(retriever, text_summaries, texts, file_id)
+        add_documents(retriever, text_summaries, texts, file_id, summary_embeddings.get("text"), "text")
     # Check that table_summaries is not empty before adding
     if table_summaries:
-        add_documents(retriever, table_summaries, tables, file_id)
+        add_documents(retriever, table_summaries, tables, file_id, summary_embeddings.get("table"), "table")
     # Check that image_summaries is not empty before adding
     if image_summaries:
-        add_documents(retriever, image_summaries, images, file_id)
+        add_documents(retriever, image_summaries, images, file_id, summary_embeddings.get("image"), "image")
 
     return retriever
@@ -0,0 +1,117 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from logging_config import logger
+
+# Seconds between two samples of the resident set size during a stage
+STAGE_RSS_SAMPLE_SECONDS = float(os.getenv("STAGE_RSS_SAMPLE_SECONDS", "0.2"))
+
+STAGE_SECONDS = Histogram(
+    'ingestion_stage_seconds', 'Wall time of an ingestion stage', ['stage'],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+STAGE_CPU_SECONDS = Histogram(
+    'ingestion_stage_cpu_seconds', 'CPU time of the process during an ingestion stage', ['stage'],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+STAGE_PEAK_RSS_BYTES = Gauge('ingestion_stage_peak_rss_bytes',
+                             'Highest sampled resident set size during the last run of an ingestion stage', ['stage'])
+STAGE_ITEMS = Counter('ingestion_stage_items', 'Items produced by an ingestion stage', ['stage'])
+PEAK_RSS_BYTES = Gauge('ingestion_peak_rss_bytes', 'Peak resident set size of the upload service since it started')
+CHILDREN_PEAK_RSS_BYTES = Gauge('ingestion_children_peak_rss_bytes',
+                                'Peak resident set size of the largest finished child process, e.g. a partition worker')
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_bytes():
+    """
+    Resident set size right now, from /proc/self/statm. Falls back to the lifetime peak where there is no /proc
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return process_peak_rss_bytes()
+
+
+def process_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux, and the peak since the process started
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_peak_rss_bytes():
+    # Peak of the largest child process waited for, partition workers run in child processes
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples the resident set size every interval seconds until stopped, keeping the highest value
+    """
+
+    def __init__(self, interval=STAGE_RSS_SAMPLE_SECONDS):
+        super().__init__(daemon=True, name="rss-sampler")
+        self.interval = interval
+        self.peak = current_rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_bytes())
+        return self.peak
+
+
+@contextmanager
+def measure_stage(metrics, stage):
+    """
+    Time the block as an ingestion stage, set record['items'] inside it to count what the stage produced.
+    The record is exported to Prometheus and stored in metrics['stages'][stage] when metrics is a dict.
+    rss_start_bytes, rss_end_bytes and peak_rss_bytes are the process's resident set size at the start, at the end
+    and the highest sampled during the stage. process_peak_rss_bytes is the peak since the process started, so it
+    only grows. cpu_seconds and the RSS fields are the whole process's, so they include concurrent jobs;
+    children_cpu_seconds counts the child processes that finished during the stage.
+    """
+    record = {}
+    sampler = RssSampler()
+    record['rss_start_bytes'] = sampler.peak
+    sampler.start()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_cpu_start = children_cpu_seconds()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - wall_start, 3)
+        record['cpu_seconds'] = round(time.process_time() - cpu_start, 3)
+        record['children_cpu_seconds'] = round(children_cpu_seconds() - children_cpu_start, 3)
+        record['peak_rss_bytes'] = sampler.stop()
+        record['rss_end_bytes'] = current_rss_bytes()
+        record['process_peak_rss_bytes'] = process_peak_rss_bytes()
+        record['children_peak_rss_bytes'] = children_peak_rss_bytes()
+        STAGE_SECONDS.labels(stage=stage).observe(record['wall_seconds'])
+        STAGE_CPU_SECONDS.labels(stage=stage).observe(record['cpu_seconds'] + record['children_cpu_seconds'])
+        STAGE_PEAK_RSS_BYTES.labels(stage=stage).set(record['peak_rss_bytes'])
+        STAGE_ITEMS.labels(stage=stage).inc(record.get('items', 0))
+        PEAK_RSS_BYTES.set(record['process_peak_rss_bytes'])
+        CHILDREN_PEAK_RSS_BYTES.set(record['children_peak_rss_bytes'])
+        if metrics is not None:
+            metrics.setdefault('stages', {})[stage] = record
+        logger.info(f"Stage '{stage}' took {record['wall_seconds']}s, {record['cpu_seconds']}s CPU, "
+                    f"{record['children_cpu_seconds']}s child CPU, peak RSS {record['peak_rss_bytes']} bytes, "
+                    f"{record.get('items', 0)} items")
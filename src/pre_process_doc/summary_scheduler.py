@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import tiktoken
+
+from logging_config import logger
+
+# Summarization requests in flight at once, per model, across all ingestion jobs of this container
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "8"))
+SUMMARY_REQUESTS_PER_MINUTE = int(os.getenv("SUMMARY_REQUESTS_PER_MINUTE", "500"))
+SUMMARY_TOKENS_PER_MINUTE = int(os.getenv("SUMMARY_TOKENS_PER_MINUTE", "40000"))
+# Attempts after a 429 before the error is raised
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", "6"))
+# Attempts after a connection error, timeout or 5xx before the error is raised
+SUMMARY_MAX_TRANSIENT_RETRIES = int(os.getenv("SUMMARY_MAX_TRANSIENT_RETRIES", "3"))
+# Errors worth another attempt that say nothing about the rate limits, APITimeoutError is an APIConnectionError
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+# Completion tokens budgeted for every request on top of the prompt
+SUMMARY_OUTPUT_TOKENS = int(os.getenv("SUMMARY_OUTPUT_TOKENS", "512"))
+
+
+class TokenBucket:
+    """
+    Allows up to per_minute units per minute, refilled continuously
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # A request larger than the whole bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_after_seconds(error):
+    """
+    Delay requested by a 429 response through the retry-after-ms or Retry-After headers
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def load_encoding(model_name):
+    """
+    The model's tiktoken encoding, None when it can't be loaded, e.g. the BPE file can't be downloaded offline
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.info(f"Could not load the tokenizer of {model_name}, estimating tokens from characters: {e}")
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.info(f"Could not load the cl100k_base tokenizer, estimating tokens from characters: {e}")
+        return None
+
+
+class SummaryScheduler:
+    """
+    Runs model calls concurrently within request and token per minute budgets.
+    Concurrency is halved on every 429 and grows back by one after a streak of successes.
+    """
+
+    def __init__(self, model_name, max_concurrency=SUMMARY_MAX_CONCURRENCY,
+                 requests_per_minute=SUMMARY_REQUESTS_PER_MINUTE, tokens_per_minute=SUMMARY_TOKENS_PER_MINUTE,
+                 max_retries=SUMMARY_MAX_RETRIES):
+        self.model_name = model_name
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.concurrency = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"summarize-{model_name}")
+        self.encoding = load_encoding(model_name)
+
+    def estimate_tokens(self, text):
+        if self.encoding is None:
+            # About four characters per token for English text
+            return len(text) // 4 + SUMMARY_OUTPUT_TOKENS
+        return len(self.encoding.encode(text, disallowed_special=())) + SUMMARY_OUTPUT_TOKENS
+
+    def _enter(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.active < self.concurrency:
+                    break
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            self.active += 1
+
+    def _exit(self, throttled, succeeded=True):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.successes = 0
+            elif succeeded:
+                self.successes += 1
+                if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def _pause(self, delay):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def _call(self, fn, item, tokens):
+        attempt = 0
+        transient_attempt = 0
+        while True:
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(tokens)
+            self._enter()
+            try:
+                result = fn(item)
+            except openai.RateLimitError as e:
+                self._exit(throttled=True)
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_after_seconds(e) or min(60, 2 ** attempt)
+                logger.info(f"Rate limited by {self.model_name}, concurrency now {self.concurrency}, "
+                            f"retrying in {delay}s")
+                self._pause(delay)
+                attempt += 1
+                continue
+            except TRANSIENT_ERRORS as e:
+                # Retried with backoff like the OpenAI client would, concurrency is left alone
+                self._exit(throttled=False, succeeded=False)
+                if transient_attempt >= SUMMARY_MAX_TRANSIENT_RETRIES:
+                    raise
+                delay = min(30, 2 ** transient_attempt)
+                logger.info(f"{type(e).__name__} from {self.model_name}, retrying in {delay}s")
+                time.sleep(delay)
+                transient_attempt += 1
+                continue
+            except Exception:
+                self._exit(throttled=False, succeeded=False)
+                raise
+            self._exit(throttled=False)
+            return result
+
+    def map(self, fn, items, texts, extra_tokens=0):
+        """
+        Call fn on every item and return the results in the order of items.
+        texts: The prompt text of every item, used to budget tokens
+        extra_tokens: Tokens added to every item's budget for non text input such as images
+        """
+        futures = [
+            self.executor.submit(self._call, fn, item, self.estimate_tokens(text) + extra_tokens)
+            for item, text in zip(items, texts)
+        ]
+        return [future.result() for future in futures]
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_summary_scheduler(model_name):
+    """
+    One scheduler per model, shared by every ingestion job so they draw from the same rate limits
+    """
+    with _schedulers_lock:
+        if model_name not in _schedulers:
+            _schedulers[model_name] = SummaryScheduler(model_name)
+        return _schedulers[model_name]
@@ -1,4 +1,7 @@
 import os
+import threading
+import time
+from datetime import datetime, timedelta
 from enum import Enum
 
 import flask
@@ -6,17 +9,27 @@ from flask import request, Flask, jsonify, make_response, url_for, render_templa
 from flask_cors import CORS
 from flask_mail import Mail
 from googleapiclient.discovery import build
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 # Local Python files
-from extraction import process_pdf
+from extraction import process_pdf, get_content_registry, index_registered_content
+from docstore.checkpoint_store import get_checkpoint_store
+from ingestion_jobs import JobStage, JobQueueFull, new_job_id, reserve_job, release_job, submit_job, \
+    active_job_for_document, active_job_ids
 from logging_config import logger
 from upload_service_helper import delete_file, connect_to_mongodb, get_company_id, \
     generate_confirmation_token, confirm_token, get_channel_members, get_channel_id, get_documents_by_channel, \
-    get_google_drive_credentials, get_file_info, download_and_save_file, persist_document_metadata, \
-    get_files_from_drive, send_notification, send_email
+    get_google_drive_credentials, get_files_info, download_and_save_file, persist_document_metadata, \
+    list_drive_files, send_notification, send_email, update_document_stage, get_document_by_job_id, \
+    job_workspace, job_workspace_path, update_document_metrics, get_documents_status, get_file_info, \
+    record_ingestion_job, touch_document_heartbeats, claim_stale_document, mark_document_failed
 
 # Define upload folder path
 UPLOAD_FOLDER = './uploads/'
+# Seconds between heartbeats of the jobs running here and scans for jobs left behind by a killed worker
+INGESTION_HEARTBEAT_SECONDS = int(os.getenv("INGESTION_HEARTBEAT_SECONDS", "60"))
+# IN_PROCESS documents whose job sent no heartbeat for this long are resumed by another worker
+INGESTION_STALE_SECONDS = int(os.getenv("INGESTION_STALE_SECONDS", "600"))
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -44,6 +57,118 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 
+# Runs on the fetch pool ahead of the job: reuses registered content or downloads the file into the job's workspace
+def fetch_file(job_id, file_info, creds, incremental=False):
+    """
+    Returns (registered content or None, downloaded PDF name or None, content hash, download metrics)
+    incremental: The file is already indexed, always download it so it can be compared item by item
+    """
+    content_hash = file_info.get('md5Checksum')
+    # Identical bytes ingested before, from any channel, only need their vectors and docstore rows written
+    registered_content = get_content_registry().get(content_hash) if content_hash and not incremental else None
+    if registered_content:
+        return registered_content, None, content_hash, {}
+    update_document_stage(connect_to_mongodb(), file_info['id'], JobStage.DOWNLOADING)
+    # Drive clients are not thread safe, so every download builds its own
+    service = build('drive', 'v3', credentials=creds)
+    work_dir = job_workspace_path(app.config['UPLOAD_FOLDER'], job_id)
+    os.makedirs(work_dir, exist_ok=True)
+    fetch_metrics = {}
+    file_name, downloaded_hash = download_and_save_file(service, file_info, work_dir, metrics=fetch_metrics)
+    logger.info(f"File '{file_name}' downloaded and saved successfully")
+    return None, file_name, content_hash or downloaded_hash, fetch_metrics
+
+
+# Runs on the ingestion worker pool, one job per file
+def ingest_file(job_id, file_info, channel_id, channel_name, user_email, incremental, fetch_future):
+    db = connect_to_mongodb()
+    file_id = file_info['id']
+    metrics = {}
+
+    def on_stage(stage):
+        update_document_stage(db, file_id, stage)
+
+    try:
+        logger.info(f"Processing file: {file_info['name']}")
+        # Every job downloads and extracts into its own directory so concurrent jobs never share files
+        with job_workspace(app.config['UPLOAD_FOLDER'], job_id) as work_dir:
+            registered_content, file_name, content_hash, fetch_metrics = fetch_future.result()
+            metrics.update(fetch_metrics)
+            metrics['content_registry_hit'] = registered_content is not None
+            if registered_content:
+                on_stage(JobStage.INDEXING)
+                index_registered_content(registered_content, channel_id, file_id)
+            else:
+                process_pdf(work_dir, file_name, channel_id, file_id, on_stage=on_stage, metrics=metrics,
+                            content_hash=content_hash, incremental=incremental, job_id=job_id)
+        logger.info(f"File '{file_info['name']}' processed successfully")
+        persist_document_metadata(db, file_info, channel_id, DocumentStatus.SUCCESS)
+        on_stage(JobStage.DONE)
+        logger.info(f"Metadata for file '{file_info['name']}' persisted successfully")
+        with app.app_context():
+            send_notification(user_email, mail, channel_name)
+    except Exception as e:
+        logger.info(f"Error processing file: {file_info['name']}")
+        logger.info(f"Error: {e}")
+        # Update status to FAILURE on error
+        persist_document_metadata(db, file_info, channel_id, DocumentStatus.FAILURE)
+        on_stage(JobStage.FAILED)
+    finally:
+        update_document_metrics(db, file_id, metrics)
+
+
+# Function to queue the ingestion of a file, a job id used before resumes from that job's checkpoints
+def queue_ingestion(db, job_id, file_info, channel_id, channel_name, user_email, creds, incremental):
+    # Raises JobQueueFull before the document's status is touched, so a full queue leaves it as it was
+    reserve_job(job_id, file_info['id'])
+    try:
+        persist_document_metadata(db, file_info, channel_id, DocumentStatus.IN_PROCESS, job_id=job_id)
+        record_ingestion_job(db, file_info['id'], user_email, channel_name, incremental)
+        update_document_stage(db, file_info['id'], JobStage.QUEUED, reset=True)
+    except Exception:
+        release_job(job_id)
+        raise
+    submit_job(job_id, file_info['id'], ingest_file, file_info, channel_id, channel_name, user_email, incremental,
+               fetch=lambda fetch_job_id: fetch_file(fetch_job_id, file_info, creds, incremental=incremental))
+
+
+# Runs in the background: keeps the heartbeat of this container's jobs fresh and resumes jobs whose
+# worker was killed, e.g. by a container eviction
+def watch_ingestion_jobs():
+    while True:
+        try:
+            db = connect_to_mongodb()
+            touch_document_heartbeats(db, active_job_ids())
+            while True:
+                document = claim_stale_document(db, INGESTION_STALE_SECONDS)
+                if document is None:
+                    break
+                if active_job_for_document(document['doc_id']):
+                    continue
+                logger.info(f"Resuming abandoned job {document['job_id']} of document {document['doc_id']}")
+                try:
+                    creds = get_google_drive_credentials(document['user_email'])
+                    file_info = get_file_info(build('drive', 'v3', credentials=creds), document['doc_id'])
+                except Exception as e:
+                    # Otherwise claimed again every stale interval, forever
+                    logger.info(f"Cannot resume job {document['job_id']}, failing document {document['doc_id']}")
+                    logger.info(e)
+                    mark_document_failed(db, document['doc_id'], str(e))
+                    continue
+                try:
+                    queue_ingestion(db, document['job_id'], file_info, document['channel_id'],
+                                    document['channel_name'], document['user_email'], creds,
+                                    document.get('incremental', False))
+                except JobQueueFull:
+                    # Claimed again once its heartbeat is stale
+                    break
+            get_checkpoint_store().purge()
+        except Exception as e:
+            logger.info("Failed to check for abandoned ingestion jobs")
+            logger.info(e)
+        time.sleep(INGESTION_HEARTBEAT_SECONDS)
+
+
 # Function to handle processing files from Google Drive
 @app.route('/process-files', methods=['POST'])
 def process_files():
@@ -52,56 +177,101 @@ def process_files():
     file_ids = data.get('file_ids', [])
     user_email = data.get('user_email')
     channel_name = data.get('channel_name')
+    # reindex=true re-ingests documents that were already processed successfully
+    reindex = data.get('reindex', False)
     company_id = get_company_id(db, user_email)
 
     # channel_id is the index name tied to pinecone index
     channel_id = get_channel_id(db, channel_name, company_id)
     logger.info(f"Index name: {channel_id}")
-    creds = get_google_drive_credentials(user_email, "")
+    creds = get_google_drive_credentials(user_email)
     service = build('drive', 'v3', credentials=creds)
 
-    for file_id in file_ids:
-        file_info = get_file_info(service, file_id)
-        collection = db['documents']
-        # Check if document already exists
-        existing_document = collection.find_one({'doc_id': file_info['id']})
-        if existing_document:
-            status = existing_document['status']
-            if status == "SUCCESS":
-                continue
-        logger.info(f"Processing file: {file_info['name']}")
-        file_name = download_and_save_file(service, file_info, app)
-        logger.info(f"File '{file_name}' downloaded and saved successfully")
-        # Persist metadata with IN_PROCESS status
-        persist_document_metadata(db, file_info, channel_id, DocumentStatus.IN_PROCESS)
-        try:
-            process_pdf(app.config['UPLOAD_FOLDER'], file_name, channel_id, file_id)
-            logger.info(f"File '{file_info['name']}' processed successfully")
-            persist_document_metadata(db, file_info, channel_id, DocumentStatus.SUCCESS)
-            logger.info(f"Metadata for file '{file_info['name']}' persisted successfully")
-            send_notification(user_email, mail, channel_name)
-        except Exception as e:
-            logger.info(f"Error processing file: {file_info['name']}")
-            logger.info(f"Error: {e}")
-            # Update status to FAILURE on error
-            persist_document_metadata(db, file_info, channel_id, DocumentStatus.FAILURE)
+    # One batched Drive call for all metadata and one query for all statuses
+    files_info = get_files_info(service, file_ids)
+    statuses = get_documents_status(db, files_info.keys())
+
+    jobs = []
+    skipped = []
+    failed = [file_id for file_id in file_ids if file_id not in files_info]
+    pending = list(files_info)
+    for position, (file_id, file_info) in enumerate(files_info.items()):
+        # Check if document already exists, unless it changed in Drive since it was indexed
+        status = statuses.get(file_id)
+        if status and status['status'] == DocumentStatus.SUCCESS.value \
+                and not (reindex or status['source_modified']):
+            skipped.append(file_id)
+            continue
+        # Documents ingested before only get their new or changed chunks, tables and images indexed
+        incremental = status is not None
+        # Don't queue a second job for a file this container, or another one still sending heartbeats, is ingesting
+        job_id = active_job_for_document(file_id)
+        if job_id is None and status and status['status'] == DocumentStatus.IN_PROCESS.value \
+                and status['heartbeat'] and status['heartbeat'] > datetime.now() - timedelta(
+                    seconds=INGESTION_STALE_SECONDS):
+            job_id = status['job_id']
+        if job_id is None:
+            # A failed or abandoned job is retried under its id, so it resumes from its checkpoints
+            if status and status['status'] != DocumentStatus.SUCCESS.value and status['job_id']:
+                job_id = status['job_id']
+            else:
+                job_id = new_job_id()
+            try:
+                queue_ingestion(db, job_id, file_info, channel_id, channel_name, user_email, creds, incremental)
+            except JobQueueFull as e:
+                # This file and the ones after it are left as they were, to be sent again later
+                not_queued = pending[position:]
+                logger.info(f"Rejecting {len(not_queued)} files: {e}")
+                response = jsonify({'message': 'Too many files are being processed, retry later', 'jobs': jobs,
+                                    'skipped': skipped, 'failed': failed, 'not_queued': not_queued})
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response, 503
+        jobs.append({'file_id': file_id, 'job_id': job_id})
 
     data = {
-        'message': 'Files downloaded and saved from the folder'
+        'message': 'Files queued for processing',
+        'jobs': jobs,
+        'skipped': skipped,
+        'failed': failed
     }
     response = jsonify(data)
     response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 202
+
+
+# Function to report the progress of an ingestion job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    db = connect_to_mongodb()
+    document = get_document_by_job_id(db, job_id)
+    if document is None:
+        response = jsonify({'message': f'Job {job_id} not found'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 404
+    response = jsonify(document)
+    response.headers.add('Access-Control-Allow-Origin', '*')
     return response, 200
 
 
+# Prometheus metrics, including the per stage ingestion timings
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    response = make_response(generate_latest())
+    response.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return response
+
+
 # Function to list files from Google Drive
 @app.route('/list-files-from-gdrive', methods=['GET'])
 def list_files():
     user_email = request.args.get('user_email')
     logger.info(f"User id we are pulling the file for for file is '{user_email}'")
+    # refresh=true rebuilds the cached listing instead of applying the Drive changes feed
+    refresh = request.args.get('refresh', 'false').lower() in ['true', '1', 't', 'y', 'yes']
     creds = get_google_drive_credentials(user_email)
     service = build('drive', 'v3', credentials=creds)
-    files = get_files_from_drive(service)
+    db = connect_to_mongodb()
+    files = list_drive_files(db, service, user_email, refresh=refresh)
     logger.info("Files retrieved successfully from Google Drive")
     response = jsonify(files)
     response.headers.add('Access-Control-Allow-Origin', '*')
@@ -171,4 +341,5 @@ def delete_file_service():
 
 
 if __name__ == '__main__':
+    threading.Thread(target=watch_ingestion_jobs, name="ingestion-watch", daemon=True).start()
     app.run(host='0.0.0.0', port=8080)
@@ -1,8 +1,11 @@
-import io
+import hashlib
 import os
-import subprocess
-from datetime import datetime
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
+import httplib2
 import psycopg2
 import requests
 from bson import ObjectId
@@ -11,16 +14,29 @@ from flask_mail import Message
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.errors import HttpError
 from itsdangerous import URLSafeTimedSerializer
 from pinecone import Pinecone
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
 
+from conversion_pool import convert_to_pdf, OFFICE_NATIVE_EXTRACTION, NATIVE_OFFICE_EXTENSIONS
 from logging_config import logger
+from stage_metrics import measure_stage
 
 # Define Google Drive API scopes
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
+# Bytes requested from Drive per range request while downloading
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+# Largest file the upload service downloads
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(200 * 1024 * 1024)))
+# Consecutive failed range requests before a download is given up
+DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", "5"))
+
+
+class FileTooLarge(Exception):
+    pass
+
 
 # Function to connect to MongoDB
 def connect_to_mongodb():
@@ -205,22 +221,120 @@ def get_documents_by_channel(db, channel_id):
         return '[]'  # Return empty JSON array in case of error
 
 
+# File types the upload service can ingest
+SUPPORTED_MIME_TYPES = ['application/pdf',
+                        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+                        'application/msword',
+                        'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+                        'application/vnd.ms-powerpoint']
+# Drive file fields kept in the per user listing cache
+LISTING_FIELDS = 'id, name, webViewLink, mimeType, modifiedTime, md5Checksum, trashed'
+
+
+# Function to list every supported file in Google Drive, following every page of results.
+# Raises when any page fails, so a partial listing is never taken for the full one
+def list_all_drive_files(service):
+    q = "(" + " or ".join(f"mimeType='{mime_type}'" for mime_type in SUPPORTED_MIME_TYPES) + ") and trashed=false"
+    items = []
+    page_token = None
+    while True:
+        results = service.files().list(fields=f"nextPageToken, files({LISTING_FIELDS})", q=q, pageSize=1000,
+                                       pageToken=page_token).execute()
+        items.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return items
+
+
 # Function to fetch files from Google Drive
 def get_files_from_drive(service):
     try:
-        q = ("mimeType='application/pdf' or mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml"
-             ".document' or mimeType='application/msword' or "
-             "mimeType='application/vnd.openxmlformats-officedocument.presentationml.presentation' or "
-             "mimeType='application/vnd.ms-powerpoint'")
-        results = service.files().list(fields="nextPageToken, files(id, name, webViewLink)", q=q).execute()
-        items = results.get('files', [])
-        return items
+        return list_all_drive_files(service)
     except Exception as e:
         logger.info("Failed to fetch files from Google Drive")
         logger.info(e)
         return []
 
 
+def cache_drive_file(db, user_email, file):
+    db['drive_files'].update_one({'user_email': user_email, 'id': file['id']},
+                                 {'$set': dict(file, user_email=user_email)}, upsert=True)
+
+
+# Function to rebuild a user's cached Drive listing from a full listing
+def refresh_drive_listing(db, service, user_email):
+    # Take the token before listing so changes made during the listing are applied next time
+    start_page_token = service.changes().getStartPageToken().execute()['startPageToken']
+    # A failed listing raises here and leaves the cached listing and its token untouched
+    files = list_all_drive_files(service)
+    # Upsert the new listing before removing files missing from it, so the cache is never empty in between
+    if files:
+        db['drive_files'].bulk_write([
+            ReplaceOne({'user_email': user_email, 'id': file['id']}, dict(file, user_email=user_email), upsert=True)
+            for file in files
+        ], ordered=False)
+    db['drive_files'].delete_many({'user_email': user_email, 'id': {'$nin': [file['id'] for file in files]}})
+    db['drive_listing_state'].update_one({'user_email': user_email},
+                                         {'$set': {'start_page_token': start_page_token,
+                                                   'refreshed_at': datetime.now()}}, upsert=True)
+    logger.info(f"Cached {len(files)} Drive files for user: {user_email}")
+
+
+# Function to apply the Drive changes feed since the stored start page token to a user's cached listing
+def apply_drive_changes(db, service, user_email, page_token):
+    """
+    Returns the ids of cached files whose content changed, documents ingested from them are flagged
+    with source_modified so they can be re-ingested
+    """
+    modified_ids = []
+    while True:
+        results = service.changes().list(
+            pageToken=page_token, spaces='drive', includeRemoved=True, pageSize=1000,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({LISTING_FIELDS}))"
+        ).execute()
+        for change in results.get('changes', []):
+            file = change.get('file')
+            if change.get('removed') or not file or file.get('trashed') \
+                    or file.get('mimeType') not in SUPPORTED_MIME_TYPES:
+                db['drive_files'].delete_one({'user_email': user_email, 'id': change['fileId']})
+                continue
+            cached = db['drive_files'].find_one({'user_email': user_email, 'id': file['id']}, {'md5Checksum': 1})
+            if cached and cached.get('md5Checksum') != file.get('md5Checksum'):
+                modified_ids.append(file['id'])
+            cache_drive_file(db, user_email, file)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            db['drive_listing_state'].update_one({'user_email': user_email},
+                                                 {'$set': {'start_page_token': results['newStartPageToken']}})
+            break
+    if modified_ids:
+        db['documents'].update_many({'doc_id': {'$in': modified_ids}}, {'$set': {'source_modified': True}})
+        logger.info(f"Drive files modified since ingestion: {modified_ids}")
+    return modified_ids
+
+
+# Function to list a user's Drive files from the cached listing, kept current with the Drive changes feed
+def list_drive_files(db, service, user_email, refresh=False):
+    try:
+        state = db['drive_listing_state'].find_one({'user_email': user_email})
+        if state is None or refresh:
+            refresh_drive_listing(db, service, user_email)
+        else:
+            try:
+                apply_drive_changes(db, service, user_email, state['start_page_token'])
+            except HttpError as e:
+                # An expired or invalid token can only be recovered from with a full listing
+                logger.info(f"Drive changes feed failed for user: {user_email}, relisting")
+                logger.info(e)
+                refresh_drive_listing(db, service, user_email)
+        projection = {'_id': 0, 'id': 1, 'name': 1, 'webViewLink': 1}
+        return list(db['drive_files'].find({'user_email': user_email}, projection))
+    except Exception as e:
+        logger.info(f"Failed to list cached Drive files for user: {user_email}")
+        logger.info(e)
+        return get_files_from_drive(service)
+
+
 # Function to fetch Google Drive credentials
 def get_google_drive_credentials(user_email):
     db = connect_to_mongodb()
@@ -264,45 +378,133 @@ def refresh_credentials(token_file):
     return creds
 
 
+# Drive file fields the upload service works with
+FILE_INFO_FIELDS = 'id, name, parents, webViewLink, mimeType, md5Checksum, size'
+# Most requests Drive accepts in one batch
+DRIVE_BATCH_SIZE = 100
+
+
 # Function to fetch file information from Google Drive
 def get_file_info(service, file_id):
-    return service.files().get(fileId=file_id, fields='id, name, parents, webViewLink, mimeType').execute()
-
-
-# Function to download and save file from Google Drive
-def download_and_save_file(service, file_info, app):
-    if file_info['mimeType'] in ['application/pdf',
-                                 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                                 'application/msword',
-                                 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-                                 'application/vnd.ms-powerpoint']:  # Add MIME types for PPT and Word
-        request = service.files().get_media(fileId=file_info['id'])
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-
-        # Save the Word document to a temporary file
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_info['name'])
-        with open(file_path, 'wb') as f:
-            f.write(fh.getbuffer())
-
-        # Convert the Word document to PDF
-        pdf_output_path = os.path.splitext(file_path)[0] + '.pdf'
-        if file_info['mimeType'] in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                                     'application/msword',
-                                     'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-                                     'application/vnd.ms-powerpoint']:
-            subprocess.run(['unoconv', '-f', 'pdf', file_path])
-            # Remove the temporary Word file
-            os.remove(file_path)
-        pdf_name = os.path.basename(pdf_output_path)
-        return pdf_name
+    return service.files().get(fileId=file_id, fields=FILE_INFO_FIELDS).execute()
+
+
+# Function to fetch file information for many files with batched Drive requests
+def get_files_info(service, file_ids):
+    """
+    Returns {file_id: file_info}, files Drive could not return are left out
+    """
+    files_info = {}
+
+    def callback(request_id, response, exception):
+        if exception:
+            logger.info(f"Failed to fetch file info for: {request_id}")
+            logger.info(exception)
+        else:
+            files_info[request_id] = response
+
+    unique_ids = list(dict.fromkeys(file_ids))
+    for start in range(0, len(unique_ids), DRIVE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for file_id in unique_ids[start:start + DRIVE_BATCH_SIZE]:
+            batch.add(service.files().get(fileId=file_id, fields=FILE_INFO_FIELDS), request_id=file_id)
+        batch.execute()
+    return files_info
+
+
+def job_workspace_path(base_dir, job_id):
+    return os.path.join(base_dir, job_id)
+
+
+# Scratch directory for a single ingestion job, removed with everything in it when the job ends
+@contextmanager
+def job_workspace(base_dir, job_id):
+    work_dir = job_workspace_path(base_dir, job_id)
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        yield work_dir
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        logger.info(f"Removed workspace for job {job_id}")
+
+
+# Function to stream a Drive file to disk in ranged chunks, resuming from the last byte written after a failure
+def stream_drive_file(service, file_info, file_path):
+    """
+    Returns the md5 hex digest of the downloaded bytes, the same digest Drive reports as md5Checksum
+    """
+    if int(file_info.get('size', 0)) > MAX_DOWNLOAD_BYTES:
+        raise FileTooLarge(f"File {file_info['id']} is {file_info['size']} bytes, limit is {MAX_DOWNLOAD_BYTES}")
+    request = service.files().get_media(fileId=file_info['id'])
+    digest = hashlib.md5()
+    offset = 0
+    total = None
+    failures = 0
+    with open(file_path, 'wb') as f:
+        while total is None or offset < total:
+            headers = {'range': f'bytes={offset}-{offset + DOWNLOAD_CHUNK_SIZE - 1}'}
+            try:
+                response, content = request.http.request(request.uri, method='GET', headers=headers)
+                if response.status == 429 or response.status >= 500:
+                    raise HttpError(response, content, uri=request.uri)
+            except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+                failures += 1
+                if failures > DOWNLOAD_MAX_RETRIES:
+                    raise
+                logger.info(f"Download of {file_info['id']} failed at byte {offset}, resuming: {e}")
+                time.sleep(2 ** failures)
+                continue
+            if response.status == 416 and offset == 0:
+                # Empty file
+                break
+            if response.status not in (200, 206):
+                raise HttpError(response, content, uri=request.uri)
+            if response.status == 200:
+                # The whole file came back in one response
+                f.seek(0)
+                f.truncate()
+                digest = hashlib.md5()
+                offset = 0
+                total = len(content)
+            else:
+                total = int(response['content-range'].split('/')[-1])
+            f.write(content)
+            digest.update(content)
+            offset += len(content)
+            failures = 0
+            if offset > MAX_DOWNLOAD_BYTES:
+                raise FileTooLarge(f"File {file_info['id']} exceeds the download limit of {MAX_DOWNLOAD_BYTES} bytes")
+    return digest.hexdigest()
+
+
+# Function to download and save file from Google Drive into the job's work_dir
+def download_and_save_file(service, file_info, work_dir, metrics=None):
+    """
+    Returns the name of the file to partition in work_dir, a PDF or a DOCX/PPTX extracted natively,
+    and the md5 hex digest of the downloaded bytes
+    metrics: Optional dict the download and conversion timings are recorded in
+    """
+    if file_info['mimeType'] in SUPPORTED_MIME_TYPES:
+        file_path = os.path.join(work_dir, file_info['name'])
+        native_extension = NATIVE_OFFICE_EXTENSIONS.get(file_info['mimeType']) if OFFICE_NATIVE_EXTRACTION else None
+        # The extension decides how the file is partitioned, Drive names don't always have one
+        if native_extension and not file_path.lower().endswith(native_extension):
+            file_path += native_extension
+        with measure_stage(metrics, 'download') as stage:
+            content_hash = stream_drive_file(service, file_info, file_path)
+            stage['items'] = 1
+            stage['bytes'] = os.path.getsize(file_path)
+
+        # Convert the Word document to PDF unless it is extracted natively
+        if file_info['mimeType'] != 'application/pdf' and not native_extension:
+            with measure_stage(metrics, 'conversion') as stage:
+                file_path = convert_to_pdf(file_path)
+                stage['items'] = 1
+        return os.path.basename(file_path), content_hash
 
 
 # Function to persist document metadata into MongoDB
-def persist_document_metadata(db, file_info, channel_id, status):
+def persist_document_metadata(db, file_info, channel_id, status, job_id=None):
     try:
         collection = db['documents']
         # Check if document already exists
@@ -310,7 +512,13 @@ def persist_document_metadata(db, file_info, channel_id, status):
 
         if existing_document:
             # Update status of existing document
-            collection.update_one({'_id': existing_document['_id']}, {'$set': {'status': status.value}})
+            update = {'$set': {'status': status.value}}
+            if job_id:
+                update['$set']['job_id'] = job_id
+            if status.value == 'SUCCESS':
+                # The index now matches the Drive file
+                update['$unset'] = {'source_modified': ''}
+            collection.update_one({'_id': existing_document['_id']}, update)
             logger.info(f"Updated status of document: {file_info['id']} to {status.value}")
         else:
             # Insert new document if it doesn't exist
@@ -320,6 +528,7 @@ def persist_document_metadata(db, file_info, channel_id, status):
                 'doc_url': file_info['webViewLink'],
                 'channel_id': channel_id,
                 'status': status.value,
+                'job_id': job_id,
                 'timestamp': datetime.now()
             }
             collection.insert_one(document)
@@ -329,6 +538,127 @@ def persist_document_metadata(db, file_info, channel_id, status):
         logger.info(e)
 
 
+# Function to look up the status of many documents with one query
+def get_documents_status(db, doc_ids):
+    """
+    Returns {doc_id: {'status': ..., 'source_modified': ..., 'job_id': ..., 'heartbeat': ...}}
+    for the documents ingested before
+    """
+    try:
+        collection = db['documents']
+        documents = collection.find({'doc_id': {'$in': list(doc_ids)}},
+                                    {'_id': 0, 'doc_id': 1, 'status': 1, 'source_modified': 1, 'job_id': 1,
+                                     'heartbeat': 1})
+        return {document['doc_id']: {'status': document.get('status'),
+                                     'source_modified': document.get('source_modified', False),
+                                     'job_id': document.get('job_id'),
+                                     'heartbeat': document.get('heartbeat')}
+                for document in documents}
+    except Exception as e:
+        logger.info(f'Failed to fetch status of documents: {doc_ids}')
+        logger.info(e)
+        return {}
+
+
+# Function to record what is needed to resume a document's ingestion job from another container
+def record_ingestion_job(db, doc_id, user_email, channel_name, incremental):
+    try:
+        collection = db['documents']
+        collection.update_one({'doc_id': doc_id}, {'$set': {
+            'user_email': user_email,
+            'channel_name': channel_name,
+            'incremental': incremental,
+            'heartbeat': datetime.now()
+        }})
+    except Exception as e:
+        logger.info(f'Failed to record ingestion job of document: {doc_id}')
+        logger.info(e)
+
+
+# Function to mark the jobs running in this container as alive
+def touch_document_heartbeats(db, job_ids):
+    if not job_ids:
+        return
+    try:
+        collection = db['documents']
+        collection.update_many({'job_id': {'$in': list(job_ids)}}, {'$set': {'heartbeat': datetime.now()}})
+    except Exception as e:
+        logger.info(f'Failed to update heartbeat of jobs: {job_ids}')
+        logger.info(e)
+
+
+# Function to take over one IN_PROCESS document whose worker stopped sending heartbeats
+def claim_stale_document(db, stale_seconds):
+    """
+    Returns the claimed document or None. Claiming refreshes the heartbeat in the same atomic update,
+    so only one container resumes the job.
+    """
+    collection = db['documents']
+    now = datetime.now()
+    return collection.find_one_and_update(
+        {
+            'status': 'IN_PROCESS',
+            'user_email': {'$exists': True},
+            '$or': [
+                {'heartbeat': {'$lt': now - timedelta(seconds=stale_seconds)}},
+                {'heartbeat': {'$exists': False}}
+            ]
+        },
+        {'$set': {'heartbeat': now}},
+        projection={'_id': 0}
+    )
+
+
+# Function to fail a document whose job can't be resumed, e.g. its file was deleted from Drive
+def mark_document_failed(db, doc_id, error):
+    try:
+        collection = db['documents']
+        entry = {'stage': 'FAILED', 'timestamp': datetime.now()}
+        collection.update_one({'doc_id': doc_id}, {'$set': {'status': 'FAILURE', 'stage': 'FAILED', 'error': error},
+                                                   '$push': {'stages': entry}})
+        logger.info(f"Updated status of document: {doc_id} to FAILURE")
+    except Exception as e:
+        logger.info(f'Failed to mark document: {doc_id} as failed')
+        logger.info(e)
+
+
+# Function to record the ingestion stage a document has reached
+def update_document_stage(db, doc_id, stage, reset=False):
+    try:
+        collection = db['documents']
+        entry = {'stage': stage.value, 'timestamp': datetime.now()}
+        if reset:
+            update = {'$set': {'stage': stage.value, 'stages': [entry]}}
+        else:
+            update = {'$set': {'stage': stage.value}, '$push': {'stages': entry}}
+        collection.update_one({'doc_id': doc_id}, update)
+    except Exception as e:
+        logger.info(f'Failed to update stage of document: {doc_id} to {stage.value}')
+        logger.info(e)
+
+
+# Function to store the metrics collected while ingesting a document
+def update_document_metrics(db, doc_id, metrics):
+    try:
+        collection = db['documents']
+        collection.update_one({'doc_id': doc_id}, {'$set': {'metrics': metrics}})
+    except Exception as e:
+        logger.info(f'Failed to update metrics of document: {doc_id}')
+        logger.info(e)
+
+
+def get_document_by_job_id(db, job_id):
+    try:
+        collection = db['documents']
+        projection = {'_id': 0, 'doc_id': 1, 'doc_name': 1, 'status': 1, 'job_id': 1, 'stage': 1, 'stages': 1,
+                      'metrics': 1}
+        return collection.find_one({'job_id': job_id}, projection)
+    except Exception as e:
+        logger.info(f'Failed to fetch document for job: {job_id}')
+        logger.info(e)
+        return None
+
+
 def get_token(code):
     try:
         url = "https://oauth2.googleapis.com/token"
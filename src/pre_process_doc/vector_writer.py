@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logging_config import logger
+
+# Vectors sent per upsert request
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
+# Upsert requests in flight at once for one document
+UPSERT_WORKERS = int(os.getenv("UPSERT_WORKERS", "4"))
+# Attempts after a failed upsert before the error is raised
+UPSERT_MAX_RETRIES = int(os.getenv("UPSERT_MAX_RETRIES", "5"))
+# Seconds before the first retry, doubled on every following one
+UPSERT_RETRY_DELAY = float(os.getenv("UPSERT_RETRY_DELAY", "0.5"))
+# "pinecone", or "memory" to keep vectors in this process, e.g. to benchmark ingestion offline
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+
+
+class InMemoryIndex:
+    """
+    Stand-in for a Pinecone index with the upsert, query and delete calls ingestion makes.
+    Queries only support $eq metadata filters and rank by dot product.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.namespaces = {}
+        self.lock = threading.Lock()
+
+    def upsert(self, vectors, namespace=""):
+        with self.lock:
+            records = self.namespaces.setdefault(namespace, {})
+            for vector in vectors:
+                records[vector["id"]] = vector
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids, namespace=""):
+        with self.lock:
+            records = self.namespaces.get(namespace, {})
+            for vector_id in ids:
+                records.pop(vector_id, None)
+
+    def query(self, vector, filter=None, top_k=10, include_metadata=False, namespace=""):
+        def matches_filter(metadata):
+            for key, condition in (filter or {}).items():
+                expected = condition["$eq"] if isinstance(condition, dict) else condition
+                if metadata.get(key) != expected:
+                    return False
+            return True
+
+        with self.lock:
+            records = [record for record in self.namespaces.get(namespace, {}).values()
+                       if matches_filter(record.get("metadata", {}))]
+        scored = sorted(
+            ((sum(a * b for a, b in zip(vector, record["values"])), record) for record in records),
+            key=lambda scored_record: scored_record[0], reverse=True
+        )[:top_k]
+        return {"matches": [
+            {"id": record["id"], "score": score, "metadata": record.get("metadata", {}) if include_metadata else None}
+            for score, record in scored
+        ]}
+
+    def describe_index_stats(self):
+        with self.lock:
+            return {"namespaces": {namespace: {"vector_count": len(records)}
+                                   for namespace, records in self.namespaces.items()},
+                    "total_vector_count": sum(len(records) for records in self.namespaces.values())}
+
+
+_memory_indexes = {}
+_memory_indexes_lock = threading.Lock()
+
+
+def get_memory_index(index_name):
+    with _memory_indexes_lock:
+        if index_name not in _memory_indexes:
+            _memory_indexes[index_name] = InMemoryIndex(index_name)
+        return _memory_indexes[index_name]
+
+
+def upsert_batch(index, batch, max_retries=UPSERT_MAX_RETRIES, retry_delay=UPSERT_RETRY_DELAY):
+    """
+    Upsert one batch, retrying with exponential backoff. Vectors are keyed by id, so a retried
+    batch that had partly been written overwrites the same records.
+    """
+    attempt = 0
+    while True:
+        try:
+            return index.upsert(vectors=batch)
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = retry_delay * 2 ** attempt
+            logger.info(f"Upsert of {len(batch)} vectors failed, retrying in {delay}s: {e}")
+            time.sleep(delay)
+            attempt += 1
+
+
+def upsert_vectors(index, vectors, batch_size=UPSERT_BATCH_SIZE, workers=UPSERT_WORKERS,
+                   max_retries=UPSERT_MAX_RETRIES):
+    """
+    Upsert vectors in batches with up to `workers` batches in flight.
+    Raises the error of the first batch that still fails after its retries.
+    """
+    batches = [vectors[start:start + batch_size] for start in range(0, len(vectors), batch_size)]
+    if not batches:
+        return
+    if workers <= 1 or len(batches) == 1:
+        for batch in batches:
+            upsert_batch(index, batch, max_retries)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(batches)), thread_name_prefix="upsert") as executor:
+        futures = [executor.submit(upsert_batch, index, batch, max_retries) for batch in batches]
+        for future in futures:
+            future.result()